@@ -0,0 +1,474 @@
+#!/usr/bin/python
+
+__doc__ = """
+Microbenchmarks for the bunny1 command pipeline.
+
+Runs Bunny1.do_command in-process for each kind of command (redirects,
+content, decorators, aliases, fallbacks, big list/help/popular pages,
+etc.) and reports ops/sec and how many objects (and bytes, where that can
+be measured) each op leaves allocated.  Results can be saved as JSON and
+compared against an earlier run to catch regressions in either before
+deploying. ex.
+
+    b1_bench.py --save before.json
+    ... change some things ...
+    b1_bench.py --compare before.json
+
+The *_raised and *_returned cases show what a command saves by returning
+its redirect or content instead of raising it.
+
+--stress checks that popularity counts come out exact when 64 threads
+count at once, and exits non-zero if any are off.
+
+--startup instead times how long a fresh python takes to import bunny1
+and resolve one command, the way --test-command and CGI requests do, and
+exits non-zero if that's over --budget.
+"""
+
+import gc
+import os
+import sys
+import time
+import threading
+import random
+import platform
+import subprocess
+from optparse import OptionParser
+
+import json
+
+import cherrypy
+from cherrypy import HTTPRedirect
+from cherrypy._cprequest import Request, Response
+try:
+    from cherrypy.lib import httputil
+except ImportError:
+    # cherrypy 3.1
+    from cherrypy.lib import http as httputil
+
+import bunny1
+
+import b1_example
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DEFAULT_NUM_COMMANDS = 2000
+DEFAULT_MIN_TIME = 0.2
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.10
+# on top of the threshold, how much more an op can leave allocated before
+# it counts as a regression, since small numbers are noisy
+OBJECTS_SLACK = 0.5
+BYTES_SLACK = 64
+DEFAULT_STARTUP_BUDGET = 0.1
+STARTUP_COMMAND = "g bunny1"
+
+# run in a fresh python so that nothing is imported yet
+STARTUP_SCRIPT = """
+import sys
+import time
+start = time.time()
+import b1_example
+b1 = b1_example.ExampleBunny()
+b1._server_mode = "COMMAND_LINE"
+b1.resolve(%r)
+print time.time() - start, "cherrypy" in sys.modules
+"""
+
+# (name, command, cookies, page cache on)
+CASES = [
+    ("redirect", "g bunny1", {}, True),
+    ("redirect_uncounted", "g bunny1", {}, True),
+    ("content", "echo hello <world>", {}, True),
+    ("decorator", "@com g bunny1", {}, True),
+    ("decorator_getattr", "@co.uk g bunny1", {}, True),
+    ("decorator_chain", "@archive @co.uk @identity g bunny1", {}, True),
+    ("alias", "search bunny1", {"alias.search": "g"}, True),
+    ("escape", "@ g bunny1", {}, True),
+    ("typed_url", "http://www.bunny1.org/some/page", {}, True),
+    ("debug", "_debug g bunny1", {}, True),
+    ("fallback", "nosuchcommand bunny1", {}, True),
+    ("list", "list", {}, True),
+    ("list_uncached", "list", {}, False),
+    ("list_search", "list wiki", {}, True),
+    ("list_search_uncached", "list wiki", {}, False),
+    ("popular", "popular", {}, True),
+    ("popular_uncached", "popular", {}, False),
+    ("help", "help", {}, True),
+    ("help_command", "help g", {}, True),
+    ("redirect_raised", "raised_redirect bunny1", {}, True),
+    ("redirect_returned", "returned_redirect bunny1", {}, True),
+    ("content_raised", "raised_content bunny1", {}, True),
+    ("content_returned", "returned_content bunny1", {}, True),
+]
+
+# cases run with popularity counting turned off, to show what counting
+# costs on the redirect path
+UNCOUNTED_CASES = ("redirect_uncounted",)
+
+# (what, raised case, returned case) for the commands in ResultCommands,
+# which are run through Bunny1.resolve instead of do_command so that the
+# only thing raised is whatever the command raises
+RESULT_PAIRS = [
+    ("redirect", "redirect_raised", "redirect_returned"),
+    ("content", "content_raised", "content_returned"),
+]
+RESOLVED_CASES = [case for pair in RESULT_PAIRS for case in pair[1:]]
+
+STRESS_THREADS = 64
+STRESS_COUNTS = 2000
+
+WORDS = ("search wiki map docs code bug task mail cal photo video news "
+         "stock weather book music shop wiki review diff build deploy "
+         "log graph dash test perf user group team page").split()
+
+class ResultCommands(b1_example.ExampleCommands):
+    """commands that give the same results by raising them, the way
+    older commands do, and by returning them"""
+
+    def raised_redirect(self, arg):
+        raise HTTPRedirect("http://www.example.com/?q=" + bunny1.qp(arg))
+
+    def returned_redirect(self, arg):
+        return "http://www.example.com/?q=" + bunny1.qp(arg)
+
+    def raised_content(self, arg):
+        raise bunny1.Content("<b>%s</b>" % bunny1.escape(arg))
+
+    def returned_content(self, arg):
+        return bunny1.Content("<b>%s</b>" % bunny1.escape(arg))
+
+def synthetic_command(url):
+    def command(self, arg):
+        return url + bunny1.q(arg)
+    return command
+
+def synthetic_commands(num, seed=0):
+    """makes a ResultCommands subclass with num more commands in it"""
+    rand = random.Random(seed)
+    attrs = {}
+    for i in xrange(num):
+        words = rand.sample(WORDS, 2)
+        name = "%s%s%d" % (words[0][:3], words[1][:2], i)
+        fun = synthetic_command("http://%s.example.com/%s?q=" % tuple(words))
+        fun.__name__ = name
+        fun.__doc__ = "goes to the %s %s for a query" % tuple(words)
+        attrs[name] = fun
+    return type("SyntheticCommands", (ResultCommands,), attrs)
+
+def make_bunny(num_commands, seed=0):
+    """makes a bunny with num_commands extra commands that have some use"""
+    commands = synthetic_commands(num_commands, seed)()
+    b1 = bunny1.Bunny1(commands, b1_example.ExampleDecorators())
+    rand = random.Random(seed)
+    names = sorted(b1.command_table.entries)
+    for name in rand.sample(names, min(len(names), 200)):
+        commands.popularity.incr(name, rand.randint(1, 1000))
+    return b1
+
+class NullCounter(bunny1.ShardedCounter):
+    """a popularity counter that doesn't count"""
+    def incr(self, key, n=1):
+        pass
+
+def load_request(cookies):
+    """sets up a cherrypy request like the one do_command would see"""
+    request = Request(httputil.Host("127.0.0.1", 8080, ""),
+                      httputil.Host("127.0.0.1", 1234, ""), "http")
+    for (key, val) in cookies.items():
+        request.cookie[key] = val
+    cherrypy.serving.load(request, Response())
+
+def run_once(b1, raw, cached, resolved=False):
+    if not cached:
+        b1.commands._page_cache.invalidate()
+    if resolved:
+        b1.resolve(raw)
+        return
+    try:
+        b1.do_command(raw)
+    except HTTPRedirect:
+        pass
+
+def time_case(b1, raw, cached, min_time, repeat, resolved=False):
+    """returns the best ops/sec for raw out of repeat runs"""
+    num = 1
+    while True:
+        t = time.time()
+        for i in xrange(num):
+            run_once(b1, raw, cached, resolved)
+        elapsed = time.time() - t
+        if elapsed >= min_time:
+            break
+        num *= 2
+    best = elapsed
+    for i in xrange(repeat - 1):
+        t = time.time()
+        for i in xrange(num):
+            run_once(b1, raw, cached, resolved)
+        best = min(best, time.time() - t)
+    return num / best
+
+def count_allocations(b1, raw, cached, num=200, resolved=False):
+    """returns (objects, bytes) per op that are still allocated after
+    running raw num times, which is what goes up when a change makes a
+    case keep more around (ex. a cache that doesn't stay bounded, or a
+    leak).
+
+    objects is the change in sys.getallocatedblocks where there is one,
+    or else the change in blocks between two tracemalloc snapshots.
+    plain python 2 has neither, so there it is the net number of new gc
+    tracked objects.  bytes comes from the tracemalloc snapshots and is
+    None without tracemalloc."""
+    getallocatedblocks = getattr(sys, "getallocatedblocks", None)
+    gc.collect()
+    gc.disable()
+    try:
+        if getallocatedblocks:
+            before = getallocatedblocks()
+        else:
+            before = gc.get_count()[0]
+        for i in xrange(num):
+            run_once(b1, raw, cached, resolved)
+        if getallocatedblocks:
+            objects = (getallocatedblocks() - before) / float(num)
+        else:
+            objects = (gc.get_count()[0] - before) / float(num)
+    finally:
+        gc.enable()
+
+    size = None
+    if tracemalloc:
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            for i in xrange(num):
+                run_once(b1, raw, cached, resolved)
+            stats = tracemalloc.take_snapshot().compare_to(before, "filename")
+        finally:
+            tracemalloc.stop()
+        size = sum([stat.size_diff for stat in stats]) / float(num)
+        if not getallocatedblocks:
+            objects = sum([stat.count_diff for stat in stats]) / float(num)
+    return (objects, size)
+
+def allocations_grew(old, new, threshold):
+    """tells whether new leaves more allocated per op than old by more
+    than threshold (plus some slack)"""
+    if new["objects_per_op"] > old["objects_per_op"] + max(OBJECTS_SLACK, abs(old["objects_per_op"]) * threshold):
+        return True
+    if new.get("bytes_per_op") is not None and old.get("bytes_per_op") is not None:
+        return new["bytes_per_op"] > old["bytes_per_op"] + max(BYTES_SLACK, abs(old["bytes_per_op"]) * threshold)
+    return False
+
+def time_startup(raw, repeat):
+    """returns (seconds, whether cherrypy got loaded) for the fastest of
+    repeat fresh pythons importing bunny1 and resolving raw"""
+    best = None
+    for i in xrange(repeat):
+        out = subprocess.Popen([sys.executable, "-c", STARTUP_SCRIPT % raw],
+                stdout=subprocess.PIPE,
+                cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+        (elapsed, loaded) = out.split()
+        elapsed = float(elapsed)
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, loaded == "True")
+
+def git_revision():
+    try:
+        return subprocess.Popen(["git", "rev-parse", "--short", "HEAD"],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def run(options, names=None):
+    b1 = make_bunny(options.num_commands)
+    b1._server_mode = "BENCHMARK"
+    results = {}
+    for (name, raw, cookies, cached) in CASES:
+        if names and name not in names:
+            continue
+        load_request(cookies)
+        popularity = b1.commands.popularity
+        if name in UNCOUNTED_CASES:
+            b1.commands.popularity = NullCounter()
+        resolved = name in RESOLVED_CASES
+        try:
+            run_once(b1, raw, cached, resolved)
+            ops = time_case(b1, raw, cached, options.min_time, options.repeat, resolved)
+            (objects, size) = count_allocations(b1, raw, cached, resolved=resolved)
+        finally:
+            b1.commands.popularity = popularity
+        results[name] = {
+            "command": raw,
+            "ops_per_sec": ops,
+            "usec_per_op": 1e6 / ops,
+            "objects_per_op": objects,
+            "bytes_per_op": size,
+        }
+        cherrypy.serving.clear()
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cherrypy": cherrypy.__version__,
+        "num_commands": options.num_commands,
+        "time": time.time(),
+        "results": results,
+    }
+
+def report(run, baseline=None, threshold=DEFAULT_THRESHOLD):
+    """prints a table of results and returns the names of the cases that
+    got slower than baseline, or left more allocated per op, by more than
+    threshold"""
+    regressions = []
+    print "%-22s %12s %10s %10s %14s" % ("case", "ops/sec", "usec/op", "objs/op", "change")
+    for (name, raw, cookies, cached) in CASES:
+        result = run["results"].get(name)
+        if not result:
+            continue
+        change = ""
+        old = baseline and baseline["results"].get(name)
+        if old:
+            ratio = result["ops_per_sec"] / old["ops_per_sec"] - 1
+            change = "%+.1f%%" % (ratio * 100)
+            if ratio < -threshold:
+                change += " !"
+            if allocations_grew(old, result, threshold):
+                change += " objs!"
+            if change.endswith("!"):
+                regressions.append(name)
+        print "%-22s %12.0f %10.1f %10.1f %14s" % (name, result["ops_per_sec"],
+                result["usec_per_op"], result["objects_per_op"], change)
+
+    counted = run["results"].get("redirect")
+    uncounted = run["results"].get("redirect_uncounted")
+    if counted and uncounted:
+        cost = 1 - counted["ops_per_sec"] / uncounted["ops_per_sec"]
+        print "popularity counting costs %.1f%% of redirect throughput" % (cost * 100)
+        if cost > threshold:
+            regressions.append("counting")
+
+    for (what, raised, returned) in RESULT_PAIRS:
+        raised = run["results"].get(raised)
+        returned = run["results"].get(returned)
+        if raised and returned:
+            print "returning %s results instead of raising them saves %.1f usec (%.0f%%)" % (
+                    what, raised["usec_per_op"] - returned["usec_per_op"],
+                    (1 - returned["usec_per_op"] / raised["usec_per_op"]) * 100)
+    return regressions
+
+def stress_counts(num_threads=STRESS_THREADS, num=STRESS_COUNTS):
+    """has num_threads threads all count at once, both straight into a
+    ShardedCounter (with another thread reading it the whole time) and by
+    resolving commands, and returns a list of (what, expected, got) for
+    every count that came out wrong"""
+    counter = bunny1.ShardedCounter()
+    b1 = make_bunny(0)
+    b1._server_mode = "BENCHMARK"
+    # make_bunny gives some commands made up counts to start with
+    before = b1.commands.popularity.get("g")
+    start = threading.Event()
+    done = []
+
+    def count(i):
+        start.wait()
+        for j in xrange(num):
+            counter.incr("shared")
+            counter.incr("thread%d" % (i % 8))
+            if j % 10 == 0:
+                b1.resolve("g bunny1")
+
+    def read():
+        start.wait()
+        while not done:
+            counter.counts()
+
+    threads = [threading.Thread(target=count, args=(i,)) for i in xrange(num_threads)]
+    reader = threading.Thread(target=read)
+    for thread in threads + [reader]:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    done.append(True)
+    reader.join()
+
+    expected = {"shared": num_threads * num}
+    for i in xrange(num_threads):
+        key = "thread%d" % (i % 8)
+        expected[key] = expected.get(key, 0) + num
+    wrong = [(key, val, counter.get(key)) for (key, val) in sorted(expected.items())
+             if counter.get(key) != val]
+    uses = before + num_threads * len(xrange(0, num, 10))
+    if b1.commands.popularity.get("g") != uses:
+        wrong.append(("popularity of g", uses, b1.commands.popularity.get("g")))
+    return wrong
+
+def main():
+    op = OptionParser(usage="usage: %prog [options] [case ...]")
+    op.add_option("-n", "--commands", dest="num_commands", type="int",
+            default=DEFAULT_NUM_COMMANDS,
+            help="number of synthetic commands to add (default: %d)" % DEFAULT_NUM_COMMANDS)
+    op.add_option("--min-time", dest="min_time", type="float", default=DEFAULT_MIN_TIME,
+            help="minimum seconds to time each case for (default: %s)" % DEFAULT_MIN_TIME)
+    op.add_option("--repeat", dest="repeat", type="int", default=DEFAULT_REPEAT,
+            help="number of timings to take the best of (default: %d)" % DEFAULT_REPEAT)
+    op.add_option("--save", dest="save", help="write the results as JSON to SAVE")
+    op.add_option("--compare", dest="compare",
+            help="compare against the JSON results in COMPARE and exit non-zero on regressions")
+    op.add_option("--threshold", dest="threshold", type="float", default=DEFAULT_THRESHOLD,
+            help="slowdown that counts as a regression (default: %s)" % DEFAULT_THRESHOLD)
+    op.add_option("--startup", dest="startup", action="store_true",
+            help="time importing bunny1 and resolving one command in a fresh python instead")
+    op.add_option("--budget", dest="budget", type="float", default=DEFAULT_STARTUP_BUDGET,
+            help="seconds --startup can take before it counts as a regression (default: %s)" % DEFAULT_STARTUP_BUDGET)
+    op.add_option("--stress", dest="stress", action="store_true",
+            help="check that counts are exact with %d threads counting at once instead" % STRESS_THREADS)
+    (options, args) = op.parse_args()
+
+    if options.stress:
+        wrong = stress_counts()
+        for (what, expected, got) in wrong:
+            print >> sys.stderr, "%s: expected %d, got %d" % (what, expected, got)
+        if wrong:
+            sys.exit(1)
+        print "stress: all counts exact with %d threads" % STRESS_THREADS
+        return
+
+    if options.startup:
+        (elapsed, loaded) = time_startup(STARTUP_COMMAND, options.repeat)
+        print "startup: %.1f ms to import bunny1 and resolve %r (budget %.1f ms, cherrypy %s)" % (
+                elapsed * 1000, STARTUP_COMMAND, options.budget * 1000,
+                loaded and "loaded" or "not loaded")
+        if elapsed > options.budget:
+            print >> sys.stderr, "startup is over budget"
+            sys.exit(1)
+        return
+
+    known = [case[0] for case in CASES]
+    for name in args:
+        if name not in known:
+            op.error("unknown case %s (cases are: %s)" % (name, ", ".join(known)))
+
+    baseline = None
+    if options.compare:
+        baseline = json.load(open(options.compare))
+
+    results = run(options, args)
+    regressions = report(results, baseline, options.threshold)
+
+    if options.save:
+        f = open(options.save, "w")
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+
+    if regressions:
+        print >> sys.stderr, "worse than %s: %s" % (options.compare, ", ".join(regressions))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
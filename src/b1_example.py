@@ -8,9 +8,9 @@ __version__ = "1.1"
 
 import urlparse
 import subprocess
+import json
 
 import bunny1
-from bunny1 import cherrypy
 from bunny1 import Content
 from bunny1 import q
 from bunny1 import qp
@@ -129,7 +129,10 @@ class ExampleCommands(bunny1.Bunny1Commands):
 
     # unlisted makes it so this command won't show up when listing all
     # commands, but the command can still be used
+    # cacheable keeps the output around for a minute so that running
+    # this over and over doesn't start a new process every time
     @bunny1.unlisted
+    @bunny1.cacheable(ttl=60, maxsize=64)
     def _finger(self, arg):
         """run finger on the host that this is running on"""
         p = subprocess.Popen(["finger", arg], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -184,6 +187,7 @@ class ExampleCommands(bunny1.Bunny1Commands):
 
     # an example of showing content instead of redirecting and also
     # using content from the filesystem
+    @bunny1.cached_page("readme")
     def readme(self, arg):
         """shows the contents of the README file for this software"""
         raise bunny1.PRE(bunny1.bunny1_file("README"))
@@ -192,8 +196,6 @@ class ExampleCommands(bunny1.Bunny1Commands):
     def _help_html(self, examples=None, name="bunny1"):
         """the help page that gets shown if no command or 'help' is entered"""
 
-        import random
-
         def bookmarklet(name):
             return """<a href="javascript:bunny1_url='""" + self._base_url() + """?';cmd=prompt('bunny1.  type &quot;help&quot; to get help or &quot;list&quot; to see commands you can use.',window.location);if(cmd){window.location=bunny1_url+escape(cmd);}else{void(0);}">""" + name + """</a>"""
 
@@ -264,7 +266,15 @@ small {
 <p>""" + name + """ is a tool that lets you write smart bookmarks in python and then share them across all your browsers and with a group of people or the whole world.  It was developed at <a href="http://www.facebook.com/">Facebook</a> and is widely used there.</p>
 
 <form method="GET">
-<p style="width: 820px; text-align: center;"><input class="test-query-input" id="b1cmd" type="text" name="___" value=""" + '"' + escape(random.choice(examples)) + '"' + """/> <input type="submit" value=" try me "/></p>
+<p style="width: 820px; text-align: center;"><input class="test-query-input" id="b1cmd" type="text" name="___" value=""" + '"' + escape(examples[0]) + '"' + """/> <input type="submit" value=" try me "/></p>
+
+<script type="text/javascript">
+// pick the example in the browser so that this page can be cached
+(function () {
+    var examples = """ + json.dumps(examples).replace("</", "<\\/") + """;
+    document.getElementById('b1cmd').value = examples[Math.floor(Math.random() * examples.length)];
+})();
+</script>
 
 <p>Type something like """ + " or ".join(["""<a href="#" onclick="return false;"><code onclick="document.getElementById('b1cmd').value = this.innerHTML; return true;">""" + x + "</code></a>" for x in examples]) + """.</p>
 
@@ -327,7 +337,7 @@ small {
         # that's not usually what you want.  this provides a workaround for 
         # that problem.
         if raw.startswith("<") and raw.endswith(">"):
-            return self._b1.do_command(raw[1:-1])
+            return self._b1.resolve(raw[1:-1])
 
         # meta-fallback
         return bunny1.Bunny1Commands.fallback(self, raw, *a, **k)
@@ -355,10 +365,11 @@ class ExampleDecorators(bunny1.Bunny1Decorators):
 
     # we don't really need to hardcode these since they should get handled
     # by the default case below, but we'll include them just as examples.
-    com = tld_rewriter("com")
-    net = tld_rewriter("net")
-    org = tld_rewriter("org")
-    edu = tld_rewriter("edu")
+    # (they're staticmethods so the lambdas don't get bound to self.)
+    com = staticmethod(tld_rewriter("com"))
+    net = staticmethod(tld_rewriter("net"))
+    org = staticmethod(tld_rewriter("org"))
+    edu = staticmethod(tld_rewriter("edu"))
 
     # make it so that you can do @co.uk -- the default decorator rewrites the TLD
     def __getattr__(self, attr):
@@ -385,15 +396,15 @@ class ExampleBunny(bunny1.Bunny1):
     """An example"""
     def __init__(self):
         bunny1.Bunny1.__init__(self, ExampleCommands(), ExampleDecorators())
+        self.assets.register_file("header.gif", bunny1.bunny1_path("header.gif"), "image/gif")
 
     # an example showing how you can handle URLs that happen before 
     # the querystring by adding methods to the Bunny class instead of 
     # the commands class
-    @cherrypy.expose
+    @expose
     def header_gif(self):
         """the banner GIF for the bunny1 homepage"""
-        cherrypy.response.headers["Content-Type"] = "image/gif"
-        return bunny1.bunny1_file("header.gif")
+        return self.assets.serve("header.gif")
 
 
 if __name__ == "__main__":
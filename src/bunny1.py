@@ -2,23 +2,186 @@
 
 import sys
 import os
+import gc
+import copy
 import re
-import cgi
 import urllib
 import urlparse
 import optparse
 import socket
+import time
+import array
+import itertools
+import threading
+import struct
+import Queue
+import collections
+import bisect
+import heapq
+import atexit
+import hashlib
+import errno
+import traceback
+import Cookie
+from cStringIO import StringIO
+from bisect import bisect_left
 
 from urllib import quote as q
 from urllib import quote_plus as qp
-from xml.sax.saxutils import escape
-
-import cherrypy
-from cherrypy import HTTPRedirect
-from cherrypy import expose
 
 from itertools import imap, izip, ifilter
 
+class LazyModule(object):
+    """stands in for a module that isn't imported until something in it is
+    used, so that running a command from the command line doesn't pay for
+    loading a whole web server.  alternates are other names to try if name
+    can't be imported, and standins are attributes to hand out until then.
+    once the module is loaded, bunny1's global for it is the real thing.
+
+    scripts that did from bunny1 import cherrypy keep the stand-in, which
+    passes everything through to the real module once anyone (bunny1 or
+    not) has imported it.  the standins are only handed out before that,
+    when nothing can be serving requests anyway."""
+
+    def __init__(self, name, alternates=(), **standins):
+        self._names = (name,) + tuple(alternates)
+        self._standins = standins
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            if attr in self._standins and not self._imported():
+                return self._standins[attr]
+            module = self._load()
+        return getattr(module, attr)
+
+    def _imported(self):
+        for name in self._names:
+            if name in sys.modules:
+                return True
+        return False
+
+    def _load(self):
+        for name in self._names:
+            try:
+                __import__(name)
+            except ImportError:
+                if name == self._names[-1]:
+                    raise
+            else:
+                break
+        self._module = sys.modules[name]
+        g = globals()
+        for (key, val) in g.items():
+            if val is self:
+                g[key] = self._module
+        return self._module
+
+class LazyClass(type):
+    """metaclass for stand-ins for classes in a LazyModule, which can be
+    raised, caught, and checked with isinstance like the real class, but
+    don't import its module until one of those actually happens"""
+
+    def _real(cls):
+        return getattr(cls._module, cls.__name__)
+
+    def __call__(cls, *args, **kwargs):
+        return cls._real()(*args, **kwargs)
+
+    def __instancecheck__(cls, obj):
+        return isinstance(obj, cls._real())
+
+    def __subclasscheck__(cls, sub):
+        return issubclass(sub, cls._real())
+
+class LazyBase(object):
+    """for classes whose base class (ex. asyncore.dispatcher) is in a
+    LazyModule.  a subclass names the base as (module, name) in
+    _lazy_base, and the first time it's made, a class that also inherits
+    from the real base is put together and used from then on."""
+
+    _lazy_base = None
+
+    def __new__(cls, *args, **kwargs):
+        (module, name) = cls._lazy_base
+        base = getattr(module, name)
+        if not issubclass(cls, base):
+            real = cls.__dict__.get("_real")
+            if real is None:
+                real = type(cls.__name__, (cls, base), {"__module__": cls.__module__})
+                cls._real = real
+            cls = real
+        return object.__new__(cls)
+
+class NoRequest(object):
+    """stands in for cherrypy.request and cherrypy.response when nothing is
+    being served (ex. with --test-command), so that commands that look at
+    cookies or headers still work without cherrypy being loaded"""
+
+    def __init__(self):
+        self.base = ""
+        self.path_info = "/"
+        self.headers = {}
+        self.cookie = Cookie.SimpleCookie()
+        self.status = None
+
+# cherrypy is only needed to actually serve requests, and it takes longer
+# to import than everything else here put together
+cherrypy = LazyModule("cherrypy", request=NoRequest(), response=NoRequest())
+_cprequest = LazyModule("cherrypy._cprequest")
+# cherrypy 3.1 calls it http
+httputil = LazyModule("cherrypy.lib.httputil", ["cherrypy.lib.http"])
+# these pull in ssl, mimetools, etc. and are only needed by the servers
+# and the upstream client
+httplib = LazyModule("httplib")
+# only the servers, worker processes, and the reloader use these
+asyncore = LazyModule("asyncore")
+asynchat = LazyModule("asynchat")
+signal = LazyModule("signal")
+mmap = LazyModule("mmap")
+imp = LazyModule("imp")
+
+class HTTPRedirect(Exception):
+    """cherrypy.HTTPRedirect, for commands that raise it (see LazyClass)"""
+    __metaclass__ = LazyClass
+    _module = cherrypy
+
+def expose(fun):
+    """marks fun as something cherrypy will serve, like cherrypy.expose"""
+    fun.exposed = True
+    return fun
+
+def escape(data):
+    """escapes &, <, and > in data, like xml.sax.saxutils.escape"""
+    return data.replace("&", "&amp;").replace(">", "&gt;").replace("<", "&lt;")
+
+# python doesn't always know about SO_REUSEPORT even when the OS does
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", None)
+if SO_REUSEPORT is None and sys.platform.startswith("linux"):
+    SO_REUSEPORT = 15
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import fcntl
+    LOCK_SH, LOCK_EX, LOCK_UN = fcntl.LOCK_SH, fcntl.LOCK_EX, fcntl.LOCK_UN
+except ImportError:
+    # no file locking on this platform, so it's up to you to make sure
+    # only one process writes to a usage log at a time
+    fcntl = None
+    LOCK_SH = LOCK_EX = LOCK_UN = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # only python 3 (or python 2 patched for pytracemalloc) has this, so
+    # memory snapshots count live objects by type instead
+    tracemalloc = None
+
 __doc__ = """
     bunny1 is a tool that lets you write smart bookmarks in python and then
     share them across all your browsers and with a group of people or the
@@ -36,8 +199,19 @@ DEFAULT_FALLBACK_URL = YUBNUB_URL
 DEFAULT_COMMAND = "help"
 DEFAULT_PORT = 9084
 
+# how many of the most recent queries we remember in memory
+DEFAULT_HISTORY_SIZE = 1000
+
+# how stale (in seconds) the popularity counts shown in popular, list,
+# and suggestions can be
+POPULARITY_MAX_AGE = 1.0
+
 BUNNY1_HOME_URL = "http://www.bunny1.org/"
 
+# static assets don't change while the server is running, so
+# browsers can hang on to them for a long time
+ASSET_MAX_AGE = 7 * 24 * 60 * 60
+
 # a list of commands that we shouldn't list as popular because
 # they sometimes get invoked behind the scenes but not usually
 # directly, and we want to avoid confusing users who look at the 
@@ -50,12 +224,74 @@ DONT_LIST_AS_POPULAR = ("echo", "url", "_setpasswd")
 # commands can start with any more than two underscores.
 COMMAND_QUERY_STRING_VAR = "___"
 
+# the query string var that browsers use to ask for OpenSearch
+# suggestions as the user types
+SUGGEST_QUERY_STRING_VAR = "_suggest"
+
+# the path that metrics are served from, in prometheus' text format
+METRICS_PATH = "_metrics"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# the path that resolves lots of commands at once (see Bunny1.batch), and
+# how many commands and bytes a single batch can have
+BATCH_PATH = "_batch"
+MAX_BATCH_SIZE = 10000
+MAX_BATCH_BYTES = 1024 * 1024
+
+# how many threads resolve the commands in batches, shared by every batch,
+# and how small a batch has to be to just be resolved by the thread that
+# got it
+BATCH_THREADS = 8
+BATCH_SERIAL_SIZE = 16
+
+# the most the async server will buffer for a request's headers and body.
+# nothing bunny1 serves takes a body bigger than a batch.
+ASYNC_MAX_HEADER_BYTES = 16 * 1024
+ASYNC_MAX_BODY_BYTES = MAX_BATCH_BYTES
+
+# --batch hands commands to its worker processes this many at a time, and
+# never has more than CLI_BATCH_WINDOW of them read in at once
+CLI_BATCH_CHUNK = 100
+CLI_BATCH_WINDOW = 10000
+
+# upper bounds (in seconds) of the buckets that command latencies go in
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# how long _profile samples for if you don't say, and at most
+DEFAULT_PROFILE_SECONDS = 30
+MAX_PROFILE_SECONDS = 300
+
+# seconds between the stack samples that _profile takes
+PROFILE_INTERVAL = 0.005
+
+# how many lines _memory diff shows
+MEMORY_DIFF_LINES = 30
+
+# the header that says how many bunny1 servers a query has been passed
+# through (see UpstreamBunny1), and how many it can go through at most
+# so that a loop of servers that fall back to each other ends
+HOPS_HEADER = "X-Bunny1-Hops"
+MAX_FEDERATION_HOPS = 5
+
+# how many compiled runs of decorators (see DecoratorChain) to keep
+MAX_DECORATOR_CHAINS = 512
+
+# the cookie that holds a user's token for the server side alias store
+ALIAS_TOKEN_COOKIE = "b1aliases"
+ALIAS_COOKIE_PREFIX = "alias."
+
 class ServerModes(object):
     """enum for different modes that the server can operate in"""
     CHERRYPY = "CHERRYPY"
     CGI = "CGI"
     COMMAND_LINE = "COMMAND_LINE"
 
+class Engines(object):
+    """enum for the different HTTP servers bunny1 can run on"""
+    CHERRYPY = "cherrypy"
+    ASYNC = "async"
+
 class Bunny1Decorators(object):
     """bunny1 decorators manipulate URLs after they are returned"""
 
@@ -66,13 +302,11 @@ class Bunny1Decorators(object):
 class Bunny1(object):
 
     def __init__(self, commands, decorators=None, server_mode=ServerModes.CHERRYPY):
+        if not decorators:
+            decorators = Bunny1Decorators()
         commands._b1 = self
         decorators._b1 = self
-        self.commands = commands
-        if decorators:
-            self.decorators = decorators
-        else:
-            self.decorators = Bunny1Decorators()
+        self.state = CommandState(commands, decorators, None)
 
         # this is just a placeholder... maybe it should be set to None
         # or "UNKNOWN"?
@@ -80,6 +314,73 @@ class Bunny1(object):
 
         self._server_mode = server_mode
 
+        # set with open_usage_log to make history and popularity durable
+        self.usage_log = None
+
+        # set with open_access_log to log every command that is resolved
+        self.access_log = None
+
+        # static files served straight out of memory
+        self.assets = AssetCache()
+        self.assets.register_file("favicon.ico", bunny1_path("favicon.ico"), "image/x-icon")
+        self.assets.register_file("blobbunny.gif", bunny1_path("blobbunny.gif"), "image/gif")
+
+        # how many of batch_pool's threads a batch (see batch) can use
+        self.batch_threads = BATCH_THREADS
+
+        # how long commands take, by command and outcome (see metrics)
+        self.latency = LatencyHistogram()
+        self.started = time.time()
+
+        # set by watch to reload commands when their code changes
+        self.reloader = None
+
+        # tuple of decorator names -> DecoratorChain
+        self._decorator_chains = {}
+
+        self.rebuild_command_table()
+
+    # these all come from state, which is only ever replaced as a whole
+    # (see Reloader.swap), so a request that reads state once never sees
+    # new commands with an old command table or decorators
+    commands = property(lambda self: self.state.commands)
+    decorators = property(lambda self: self.state.decorators)
+    command_table = property(lambda self: self.state.command_table)
+
+    def watch(self, interval=1.0):
+        """reloads the commands and decorators whenever the code that they
+        come from changes, without restarting (see Reloader).  this takes
+        effect when the server starts."""
+        self.reloader = Reloader(self, interval)
+        return self.reloader
+
+    def rebuild_command_table(self):
+        """rebuilds the dispatch table for self.commands.  call this after
+        adding, removing, or replacing commands on a running instance"""
+        state = self.state
+        self.state = CommandState(state.commands, state.decorators,
+                                  CommandTable(state.commands), state.modules)
+        invalidate_pages(state.commands)
+
+    def open_usage_log(self, path, **kwargs):
+        """loads history and popularity from the usage log at path and
+        keeps logging to it from now on.  see UsageLog for the kwargs."""
+        usage_log = UsageLog(path, history_size=self.commands.history.size, **kwargs)
+        usage_log.load(self.commands.history, self.commands.popularity)
+        usage_log.start()
+        atexit.register(usage_log.close)
+        self.usage_log = usage_log
+        return usage_log
+
+    def open_access_log(self, path, **kwargs):
+        """logs every command that gets resolved to path from now on.
+        see AccessLog for the kwargs."""
+        access_log = AccessLog(path, **kwargs)
+        access_log.start()
+        atexit.register(access_log.close)
+        self.access_log = access_log
+        return access_log
+
     def server_mode(self):
         """returns what mode the server is in (CHERRYPY or CGI)"""
         return self._server_mode
@@ -100,25 +401,213 @@ class Bunny1(object):
 
     @expose
     def default(self, *a, **k):
+        return self.respond(self.route(a, k))
+
+    def route(self, a, k):
+        """works out the response to a request for the path segments a with
+        the query string params k.  returns a Redirect, Content, or the
+        body to send."""
+
+        # any static assets that have been registered are served
+        # from the path they were registered under
+        if a:
+            path = "/".join(a)
+            if path in self.assets:
+                return self.assets.serve(path)
+            if path == METRICS_PATH:
+                return self.authorized_metrics()
+            if path == BATCH_PATH:
+                return self.batch(request_body(MAX_BATCH_BYTES))
+            # cherrypy has already dispatched these when it's serving, but
+            # the WSGI and async servers only have route
+            fun = self.exposed_method(a[0])
+            if fun is not None:
+                return fun(*a[1:], **k)
 
         raw = None
         for raw in k:
             break
         if raw == COMMAND_QUERY_STRING_VAR:
             raw = k[COMMAND_QUERY_STRING_VAR]
+        elif raw == SUGGEST_QUERY_STRING_VAR:
+            # this gets hit on every keystroke so it skips resolve entirely
+            return self.suggest(k[SUGGEST_QUERY_STRING_VAR])
 
-        return self.do_command(raw, a, k)
+        return self.resolve(raw, a, k)
+
+    def exposed_method(self, name):
+        """the @expose'd method that cherrypy would serve for the path
+        segment name, if there is one"""
+        fun = getattr(self, name.replace(".", "_"), None)
+        if name == "default" or not getattr(fun, "exposed", False):
+            return None
+        return fun
+
+    def wsgi(self, environ, start_response):
+        """a WSGI application that runs this instance of bunny1 without
+        going through CherryPy's server.  see wsgi_app."""
+        (code, headers, body) = self.serve_request(self._wsgi_request(environ))
+        start_response("%d %s" % (code, httplib.responses.get(code, "")), headers)
+        return [body]
+
+    def serve_request(self, request):
+        """runs a request given a cherrypy request object, without any of
+        cherrypy's server machinery, and returns (status code, header list,
+        body)"""
+        response = _cprequest.Response()
+        cherrypy.serving.load(request, response)
+        try:
+            try:
+                result = self.route([seg for seg in request.path_info.split("/") if seg],
+                                    self._query_params(request.query_string))
+                if isinstance(result, Redirect):
+                    # the same thing HTTPRedirect would do, minus the exception
+                    if request.protocol >= (1, 1):
+                        status = 303
+                    else:
+                        status = 302
+                    response.headers["Location"] = absolute_url(result.url)
+                    body = ""
+                else:
+                    body = self.respond(result)
+                    status = response.status or 200
+            except cherrypy.HTTPRedirect, redir:
+                status = redir.status
+                response.headers["Location"] = redir.urls[0]
+                body = ""
+            except cherrypy.HTTPError, e:
+                status = e.status
+                body = ""
+        finally:
+            cherrypy.serving.clear()
+
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
+        body = body or ""
+        headers = [(k, str(v)) for (k, v) in response.headers.items()]
+        headers.append(("Content-Length", str(len(body))))
+        for morsel in response.cookie.values():
+            headers.append(("Set-Cookie", morsel.OutputString()))
+        try:
+            code = int(status)
+        except ValueError:
+            # a full status line, ex. "304 Not Modified"
+            code = int(str(status).split()[0])
+        return (code, headers, body)
+
+    def _wsgi_request(self, environ):
+        """makes a cherrypy request object for a WSGI environ"""
+        scheme = environ.get("wsgi.url_scheme", "http")
+        host = environ.get("HTTP_HOST") or environ.get("SERVER_NAME", "localhost")
+        request = _cprequest.Request(httputil.Host(environ.get("SERVER_NAME", ""), int(environ.get("SERVER_PORT") or 80)),
+                          httputil.Host(environ.get("REMOTE_ADDR", ""), int(environ.get("REMOTE_PORT") or 0)),
+                          scheme, environ.get("SERVER_PROTOCOL", "HTTP/1.1"))
+        if request.server_protocol == "HTTP/1.0":
+            request.protocol = (1, 0)
+        request.base = "%s://%s" % (scheme, host)
+        request.script_name = environ.get("SCRIPT_NAME", "")
+        request.path_info = environ.get("PATH_INFO") or "/"
+        request.query_string = environ.get("QUERY_STRING", "")
+        request.method = environ.get("REQUEST_METHOD", "GET")
+        request.rfile = environ.get("wsgi.input")
+
+        headers = httputil.HeaderMap()
+        for (key, val) in environ.iteritems():
+            if key.startswith("HTTP_"):
+                headers[key[5:].replace("_", "-").title()] = val
+            elif key in ("CONTENT_TYPE", "CONTENT_LENGTH") and val:
+                headers[key.replace("_", "-").title()] = val
+        request.headers = headers
+
+        request.cookie = Cookie.SimpleCookie()
+        try:
+            request.cookie.load(environ.get("HTTP_COOKIE", ""))
+        except Cookie.CookieError:
+            pass
+        return request
+
+    def _query_params(self, query_string):
+        """parses a query string into params the way cherrypy does"""
+        params = {}
+        for (key, val) in urlparse.parse_qsl(query_string, keep_blank_values=True):
+            if key not in params:
+                params[key] = val
+        return params
+
+    def suggest(self, query, limit=10):
+        """sends OpenSearch suggestions for a partially typed command"""
+        cherrypy.response.headers["Content-Type"] = "application/x-suggestions+json"
+        return json.dumps(self.suggestions(query, limit))
+
+    def suggestions(self, query, limit=10):
+        """returns [query, [completions], [descriptions]] for a partially
+        typed command, with the most popular commands first"""
+        query = query or ""
+        prefix = query.lstrip()
+        if not prefix or len(prefix.split(None, 1)) > 1 or prefix[-1].isspace():
+            # the user is already typing the argument
+            return [query, [], []]
+        names = self.command_table.trie.complete(prefix, self.commands.popularity, limit)
+        entries = self.command_table.entries
+        return [query, names, [entries[name].doc or "" for name in names]]
 
     def do_command(self, raw, a=(), k={}):
         """does the specified command"""
-
-        self.commands.history.append(raw)
+        return self.respond(self.resolve(raw, a, k))
+
+    def respond(self, result):
+        """sends a result from resolve the way cherrypy expects, by raising
+        HTTPRedirect for a Redirect and returning the body for Content"""
+        if isinstance(result, Redirect):
+            raise cherrypy.HTTPRedirect(result.url)
+        if isinstance(result, Content):
+            cherrypy.response.headers['Content-Type'] = result.content_type
+            if result.etag:
+                cherrypy.response.headers['ETag'] = result.etag
+                if etag_matches(result.etag, cherrypy.request.headers.get("If-None-Match")):
+                    cherrypy.response.status = 304
+                    return ""
+            return result.html
+        return result
+
+    def resolve(self, raw, a=(), k={}):
+        """works out what the specified command does and returns it as a
+        Redirect or as Content.  nothing is raised for the common cases, so
+        this is cheaper than do_command for callers that don't need to go
+        through cherrypy."""
+        start = time.time()
+        command = ""
+        outcome = Outcomes.ERROR
+        result = None
+        try:
+            (command, outcome, result) = self._resolve(raw, a, k)
+        finally:
+            elapsed = time.time() - start
+            self.latency.observe((command, outcome), elapsed)
+            if self.access_log:
+                self.access_log.record(start, command, outcome, result, elapsed, raw)
+        if outcome == Outcomes.UNAUTHORIZED:
+            # unauthorized usually raises (ex. a 404), so it isn't called
+            # until the outcome has been recorded
+            result = body_result(self.unauthorized())
+        return result
+
+    def _resolve(self, raw, a, k, record=True):
+        """does the work for resolve and returns (command, outcome, result).
+        command is "" unless raw turned out to be a real command so that
+        the metrics don't get a label for everything anyone types.  result
+        is None when the outcome is UNAUTHORIZED (see resolve).  unless
+        record is True, raw isn't added to history or popularity."""
+
+        state = self.state
+        if record:
+            state.commands.history.append(raw)
+            if self.usage_log:
+                self.usage_log.record_query(raw)
         if not raw:
             raw = DEFAULT_COMMAND
 
-        # setup a namespace in the request for bunny1 stuff
-        cherrypy.request.bunny1 = {"decorators": []}
-
+        names = []
         while True:
             try:
                 (method, arg) = raw.split(None, 1)
@@ -126,25 +615,30 @@ class Bunny1(object):
                 method = raw
                 arg = ""
             if method.startswith("@") and method != "@":
-                try:
-                    d = getattr(self.decorators, method[1:])
-                    if d.exposed:
-                        cherrypy.request.bunny1["decorators"].append(d)
-                    else:
-                        # shold really use a different kind of exception
-                        # and raise that here, but this works for now
-                        raise DoesNotExist(method)
-                    raw = arg
-                except (AttributeError, DoesNotExist):
-                    return self.error("no decorator named %s %s" % (escape(method), repr(self.decorators)))
+                names.append(method[1:])
+                raw = arg
             else:
                 break
 
+        chain = None
+        if names:
+            chain = self.decorator_chain(tuple(names), state.decorators)
+            if chain is None:
+                for name in names:
+                    if not is_decorator(getattr(state.decorators, name, None)):
+                        break
+                return ("", Outcomes.ERROR, Content(self.error("no decorator named %s %s" % (escape("@" + name), repr(state.decorators)))))
+
+        # setup a namespace in the request for bunny1 stuff
+        if chain:
+            cherrypy.request.bunny1 = {"decorators": list(chain.funs)}
+        else:
+            cherrypy.request.bunny1 = {"decorators": []}
+
         # use aliases
-        try:
-            method = cherrypy.request.cookie["alias." + method].value
-        except KeyError:
-            pass
+        real = state.commands.lookup_alias(method)
+        if real is not None:
+            method = real
 
         # @ is a symbol that works if you have a server on your LAN
         # with the same name as a command you want to use
@@ -158,7 +652,7 @@ class Bunny1(object):
         # go to the default URL if there is just a decorator given
         if method == "":
             method = "url"
-            arg = self.decorators.default_url()
+            arg = state.decorators.default_url()
 
         # if you type in a URL, just go there
         if urlparse.urlsplit(method)[0]:
@@ -167,86 +661,281 @@ class Bunny1(object):
 
         # debug mode: gives the URLs of redirects rather than redirecting
         if method == "_debug":
-            try:
-                return self.do_command(arg)
-            except HTTPRedirect, redir:
-                url = escape(redir.urls[0])
-                return "<code><b>bunny1</b> DEBUG: redirect to <a href='%s'>%s</a></code>" % (url, url)
+            result = self.resolve(arg)
+            if isinstance(result, Redirect):
+                url = escape(result.url)
+                result = Content("<code><b>bunny1</b> DEBUG: redirect to <a href='%s'>%s</a></code>" % (url, url))
+            return (method, Outcomes.CONTENT, result)
 
         # we don't want people calling things like __str__, etc.
         # it seems likely to lead to exploits
         if method.startswith("__"):
-            return self.error("commands can't start with a double underscore")
-
-
-        try:
-            try:
-                cmd = getattr(self.commands, method)
-                if hasattr(cmd, "dont_expose") and cmd.dont_expose:
-                    raise Fallback("method not exposed")
-                if not callable(cmd):
-                    raise Fallback("method not callable")
-            except AttributeError:
-                raise Fallback("no method")
+            return ("", Outcomes.ERROR, Content(self.error("commands can't start with a double underscore")))
 
+        entry = state.command_table.lookup(method)
+        if entry is None:
+            return ("", Outcomes.FALLBACK, self._fallback_result(raw, a, k))
 
-            # check whether the user is authorized
-            if not self.auth() and not getattr(cmd, "no_auth_required", False):
-                return self.unauthorized()
+        # check whether the user is authorized
+        if not self.auth() and not entry.no_auth_required:
+            return (method, Outcomes.UNAUTHORIZED, None)
 
-            # Tell the user what host we are on for easier troubleshooting.
+        # Tell the user what host we are on for easier troubleshooting.
+        if self._server_mode != ServerModes.COMMAND_LINE:
             cherrypy.response.headers['X-Bunny1-Host'] = cherrypy.server.socket_host
 
-            # we invert the normal cherrypy paradigm here
-            # since the common case is that we want to redirect
-            # and the exceptional case is that we want to send content
-            # to the browser
-            try:
-
-                # keep track of which are the most popular commands
-                # to use so we can surface those
-                if method:
-                    popularity = self.commands.popularity
-                    popularity[method] = popularity.get(method, 0) + 1
-
-                # do any transformations that we want to do
-                preprocessor = getattr(cmd, "preprocessor", None)
-                if callable(preprocessor):
-                    arg = preprocessor(arg)
-
-                url = cmd(arg)
-
-                # if the command doesn't do anything, just say "done."
-                if url is None:
-                    return "done."
-
-                for decorator_method in cherrypy.request.bunny1["decorators"][::-1]:
-                    url = decorator_method(url)
-
-                raise HTTPRedirect(url)
-            except Content, content:
-                cherrypy.response.headers['Content-Type'] = content.content_type
-                return content.html
+        # keep track of which are the most popular commands
+        # to use so we can surface those
+        if method and record:
+            state.commands.popularity.incr(method)
+            if self.usage_log:
+                self.usage_log.record_use(method)
 
+        # commands and decorators usually return a URL (or a Redirect) but
+        # they can also return Content, and older ones raise Content or
+        # HTTPRedirect instead, which still works
+        try:
+            # do any transformations that we want to do
+            if entry.preprocessor:
+                arg = entry.preprocessor(arg)
+
+            result = entry.fun(arg)
+
+            # decorators only get URLs
+            if chain and result is not None and not isinstance(result, Content):
+                if isinstance(result, Redirect):
+                    result = result.url
+                result = chain.apply(result)
+        except Content, content:
+            return (method, Outcomes.CONTENT, content)
+        except cherrypy.HTTPRedirect, redir:
+            return (method, Outcomes.REDIRECT, Redirect(redir.urls[0]))
         except Fallback:
-            return self.fallback(raw, *a, **k)
+            return (method, Outcomes.FALLBACK, self._fallback_result(raw, a, k))
+
+        # if the command doesn't do anything, just say "done."
+        if result is None:
+            return (method, Outcomes.CONTENT, Content("done."))
+        if isinstance(result, Content):
+            return (method, Outcomes.CONTENT, result)
+        if isinstance(result, Redirect):
+            return (method, Outcomes.REDIRECT, result)
+        return (method, Outcomes.REDIRECT, Redirect(result))
+
+    def decorator_chain(self, names, decorators=None):
+        """returns a DecoratorChain for the decorators named in the tuple
+        names (without their @s), or None if any of them isn't an exposed
+        decorator.  chains are only looked up and put together the first
+        time a run of decorators is used."""
+        if decorators is None:
+            decorators = self.decorators
+        chain = self._decorator_chains.get(names)
+        if chain is not None and chain.owner is decorators:
+            return chain
+        funs = []
+        for name in names:
+            d = getattr(decorators, name, None)
+            if not is_decorator(d):
+                return None
+            funs.append(d)
+        if len(self._decorator_chains) >= MAX_DECORATOR_CHAINS:
+            # like the re module's cache, it just starts over when it's full
+            self._decorator_chains.clear()
+        chain = DecoratorChain(decorators, funs)
+        self._decorator_chains[names] = chain
+        return chain
+
+    def _fallback_result(self, raw, a, k):
+        """calls fallback and turns whatever it does into a result"""
+        try:
+            return body_result(self.fallback(raw, *a, **k))
+        except Content, content:
+            return content
+        except cherrypy.HTTPRedirect, redir:
+            return Redirect(redir.urls[0])
 
     def fallback(self, raw, *a, **k):
         return self.commands.fallback(raw)
 
+    def batch(self, body):
+        """resolves every command in body, which is either a JSON list of
+        strings or one command per line, and returns Content with a JSON
+        list of the results in the same order.  each result is one of
+            {"redirect": url}
+            {"content": html, "content_type": content_type}
+            {"error": message}
+        so that tools that resolve lots of commands (ex. link checkers)
+        can do it in one request.  big batches are resolved on up to
+        batch_threads of batch_pool's threads at once."""
+        try:
+            raws = parse_batch(body)
+        except ValueError, e:
+            cherrypy.response.status = 400
+            return Content(json.dumps({"error": str(e)}), "application/json")
+
+        results = [None] * len(raws)
+        num_threads = min(self.batch_threads, batch_pool.num_threads, len(raws))
+        if len(raws) <= BATCH_SERIAL_SIZE or num_threads <= 1:
+            for (i, raw) in enumerate(raws):
+                results[i] = self._batch_result(raw)
+        else:
+            work = Queue.Queue()
+            for item in enumerate(raws):
+                work.put(item)
+            # cherrypy's request and response are per thread, so each
+            # thread gets its own copy of the request to resolve with and
+            # its own response, whose cookies and headers (ex. from alias)
+            # are put back into the real response afterwards
+            request = cherrypy.serving.request
+            response = cherrypy.serving.response
+            responses = []
+            def resolve_all():
+                copied = copy.copy(request)
+                copied.cookie = copy.copy(request.cookie)
+                # so that they all end up with the same new alias token
+                # (see Bunny1Commands._alias_token)
+                copied.batch_request = request
+                own = _cprequest.Response()
+                responses.append(own)
+                cherrypy.serving.load(copied, own)
+                try:
+                    while True:
+                        try:
+                            (i, raw) = work.get_nowait()
+                        except Queue.Empty:
+                            return
+                        results[i] = self._batch_result(raw)
+                finally:
+                    cherrypy.serving.clear()
+            batch_pool.run_all(resolve_all, [()] * num_threads)
+            for own in responses:
+                response.cookie.update(own.cookie)
+                for (name, val) in own.headers.iteritems():
+                    if name not in response.headers:
+                        response.headers[name] = val
+
+        return Content(json.dumps(results), "application/json")
+
+    def _batch_result(self, raw):
+        """resolves raw and turns the result into something for batch"""
+        try:
+            result = self.resolve(raw)
+        except cherrypy.HTTPError, e:
+            return {"error": "HTTP %s" % e.status}
+        except Exception, e:
+            cherrypy.log("error resolving %r in a batch" % raw, traceback=True)
+            return {"error": "%s: %s" % (e.__class__.__name__, e)}
+        if isinstance(result, Redirect):
+            return {"redirect": absolute_url(result.url)}
+        return {"content": result.html, "content_type": result.content_type}
+
+    def check(self, raw):
+        """resolves raw and returns a dict saying what it did, for checking
+        lots of commands at once from the command line (see run_batch).
+        it has the command and the outcome (see Outcomes) and then either
+        the redirect URL, the content type and an MD5 of the content, or
+        the error that was raised.  checks aren't real uses, so they don't
+        go in history or popularity."""
+        line = {"command": raw}
+        try:
+            (command, outcome, result) = self._resolve(raw, (), {}, record=False)
+        except Exception, e:
+            line["outcome"] = Outcomes.ERROR
+            line["error"] = "%s: %s" % (e.__class__.__name__, e)
+            return line
+        line["outcome"] = outcome
+        if isinstance(result, Redirect):
+            line["redirect"] = result.url
+        elif result is not None:
+            html = result.html or ""
+            if isinstance(html, unicode):
+                html = html.encode("utf-8")
+            line["content_type"] = result.content_type
+            line["digest"] = hashlib.md5(html).hexdigest()
+        return line
+
+    def authorized_metrics(self):
+        """metrics, for users that are authorized to use this instance"""
+        if not self.auth():
+            return body_result(self.unauthorized())
+        return self.metrics()
+
+    def metrics(self):
+        """returns Content with command latencies, request counts, and the
+        sizes of history and popularity in prometheus' text format.  the
+        latencies are for this process only; with --workers, each worker
+        has its own."""
+        lines = []
+        def metric(name, kind, doc):
+            lines.append("# HELP %s %s" % (name, doc))
+            lines.append("# TYPE %s %s" % (name, kind))
+
+        bounds = ["%g" % bound for bound in self.latency.buckets] + ["+Inf"]
+        totals = {}
+        metric("bunny1_command_duration_seconds", "histogram",
+               "time taken to resolve commands, by command and outcome")
+        for ((command, outcome), counts) in sorted(self.latency.merged().iteritems()):
+            labels = 'command="%s",outcome="%s"' % (prometheus_escape(command), outcome)
+            total = 0
+            for (bound, count) in izip(bounds, counts):
+                total += count
+                lines.append('bunny1_command_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, total))
+            lines.append("bunny1_command_duration_seconds_sum{%s} %r" % (labels, counts[-1]))
+            lines.append("bunny1_command_duration_seconds_count{%s} %d" % (labels, total))
+            totals[outcome] = totals.get(outcome, 0) + total
+
+        # prometheus' rate() turns this into requests per second
+        metric("bunny1_requests_total", "counter", "commands resolved, by outcome")
+        for outcome in Outcomes.ALL:
+            lines.append('bunny1_requests_total{outcome="%s"} %d' % (outcome, totals.get(outcome, 0)))
+
+        history = self.commands.history.last_timed()
+        popularity = self.commands.popularity.counts()
+        metric("bunny1_history_size", "gauge", "queries kept in history")
+        lines.append("bunny1_history_size %d" % len(history))
+        metric("bunny1_popularity_size", "gauge", "distinct commands counted in popularity")
+        lines.append("bunny1_popularity_size %d" % len(popularity))
+        metric("bunny1_popularity_uses_total", "counter", "command uses counted in popularity")
+        lines.append("bunny1_popularity_uses_total %d" % sum(popularity.itervalues()))
+        if self.usage_log:
+            metric("bunny1_usage_log_dropped_total", "counter",
+                   "usage log records dropped because the disk fell behind")
+            lines.append("bunny1_usage_log_dropped_total %d" % self.usage_log.dropped)
+        if self.access_log:
+            metric("bunny1_access_log_dropped_total", "counter",
+                   "access log records dropped because the writer fell behind")
+            lines.append("bunny1_access_log_dropped_total %d" % self.access_log.dropped)
+        metric("process_start_time_seconds", "gauge", "when this process started serving")
+        lines.append("process_start_time_seconds %r" % self.started)
+
+        return Content("\n".join(lines) + "\n", PROMETHEUS_CONTENT_TYPE)
+
     @expose
     def favicon_ico(self, *args, **kwargs):
         """favicon.ico file.  blobbunny made by julie zhuo :)"""
-        cherrypy.response.headers["Content-Type"] = "image/x-icon"
-        return bunny1_file("favicon.ico")
+        return self.assets.serve("favicon.ico")
 
     @expose
     def blobbunny_gif(self, *args, **kwargs):
         """blobbunny.gif logo, made by julie zhuo"""
-        cherrypy.response.headers["Content-Type"] = "image/gif"
-        return bunny1_file("blobbunny.gif")
+        return self.assets.serve("blobbunny.gif")
+
+    @expose
+    def _metrics(self, *args, **kwargs):
+        """metrics for prometheus to scrape"""
+        return self.respond(self.authorized_metrics())
 
-    def start(self, port=None, host=None, errorlogfile=None, accesslogfile=None):
+    @expose
+    def _batch(self, *args, **kwargs):
+        """resolves lots of commands at once (see batch)"""
+        return self.respond(self.batch(request_body(MAX_BATCH_BYTES)))
+    # batch reads the body itself, so cherrypy shouldn't try to parse it
+    _batch._cp_config = {"request.process_request_body": False}
+
+    def start(self, port=None, host=None, errorlogfile=None, accesslogfile=None, workers=1, engine=Engines.CHERRYPY):
+        """runs the server.  if workers is more than 1, that many worker
+        processes are preforked that all listen on the same port.  engine
+        is one of Engines."""
         if port:
             cherrypy.server.socket_port = port
         if errorlogfile:
@@ -258,10 +947,874 @@ class Bunny1(object):
         else:
             from socket import gethostname
             cherrypy.server.socket_host = gethostname()
+        if self.reloader:
+            # cherrypy's own autoreloader would restart the whole process
+            cherrypy.config.update({"engine.autoreload.on": False})
+        if workers > 1:
+            return self.start_workers(workers, engine)
+        if self.reloader:
+            self.reloader.start()
+        if engine == Engines.ASYNC:
+            return self.serve_async()
         return cherrypy.quickstart(self)
 
+    def serve_async(self, reuse_port=False):
+        """runs this instance on an AsyncServer until interrupted"""
+        server = AsyncServer(self, cherrypy.server.socket_host, cherrypy.server.socket_port, reuse_port)
+        # the event loop can't wait on the upstream server
+        upstream = getattr(self.commands, "upstream", None)
+        if upstream is not None:
+            upstream.blocking = False
+        print >> sys.stderr, "bunny1: serving on http://%s:%s/" % (server.host, server.port)
+        try:
+            asyncore.loop(timeout=30, use_poll=True)
+        finally:
+            server.close()
+
+    def start_workers(self, workers, engine=Engines.CHERRYPY):
+        """forks workers processes that each run a server listening on the
+        same port (with SO_REUSEPORT so the kernel spreads connections
+        between them), and restarts any that die.  returns once the
+        supervisor gets SIGINT or SIGTERM and all the workers have exited."""
+        if SO_REUSEPORT is None:
+            raise ValueError("running more than one worker requires SO_REUSEPORT")
+
+        import tempfile
+        import shutil
+        stats = WorkerStats(tempfile.mkdtemp(prefix="bunny1-workers-"))
+        children = {}
+        stopping = []
+
+        def spawn():
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    try:
+                        self._serve_worker(stats, engine)
+                        status = 0
+                    except SystemExit:
+                        status = 0
+                    except:
+                        traceback.print_exc()
+                finally:
+                    os._exit(status)
+            children[pid] = time.time()
+
+        def stop(signum, frame):
+            stopping.append(signum)
+            for pid in children.keys():
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        for i in xrange(workers):
+            spawn()
+        print >> sys.stderr, "bunny1: supervising %d workers on %s:%s" % (workers, cherrypy.server.socket_host, cherrypy.server.socket_port)
+
+        while children:
+            try:
+                (pid, status) = os.waitpid(-1, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            started = children.pop(pid, None)
+            if started is not None and not stopping:
+                print >> sys.stderr, "bunny1: worker %d exited with status %d, restarting it" % (pid, status)
+                # don't spin if workers are dying as soon as they start
+                if time.time() - started < 1:
+                    time.sleep(1)
+                spawn()
+
+        shutil.rmtree(stats.directory, True)
+
+    def _serve_worker(self, stats, engine):
+        """runs the server in a worker process forked by start_workers"""
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        if self.usage_log:
+            self.usage_log.after_fork()
+        if self.access_log:
+            self.access_log.after_fork()
+        stats.attach(self.commands)
+        if self.reloader:
+            self.reloader.start()
+
+        try:
+            if engine == Engines.ASYNC:
+                self.serve_async(reuse_port=True)
+            else:
+                # we run our own server instead of cherrypy.server since it
+                # refuses to start when something (ex. another worker) is
+                # already listening on the port
+                cherrypy.server.unsubscribe()
+                # the supervisor restarts workers, and cherrypy's
+                # autoreloader would only restart the engine, leaving
+                # httpserver serving the old code
+                cherrypy.config.update({"engine.autoreload.on": False})
+                cherrypy.tree.mount(self)
+                httpserver = reuse_port_wsgi_server(cherrypy.server)
+                cherrypy.engine.start()
+                try:
+                    httpserver.start()
+                finally:
+                    httpserver.stop()
+                    cherrypy.engine.exit()
+        finally:
+            if self.usage_log:
+                self.usage_log.close()
+            if self.access_log:
+                self.access_log.close()
+
+class Reloader(object):
+    """watches the source files that a Bunny1 instance's commands and
+    decorators classes (and their base classes) come from.  when one
+    changes, new commands and decorators are built from the new code and
+    a new command table is built for them in the background, and then
+    they are all swapped into the Bunny1 instance at once as a new
+    CommandState.  history, popularity, and the other things in keep
+    carry over to the new commands.  if anything goes wrong while
+    building them, the old ones stay in place."""
+
+    # the commands attributes that carry over to the new commands
+    keep = ("history", "popularity", "upstream", "fallback_url", "alias_store", "profiler", "memory")
+
+    def __init__(self, b1, interval=1.0):
+        self.b1 = b1
+        self.interval = interval
+        self.reloads = 0
+        self.errors = 0
+        self._stats = self._scan()
+        # files that changed for a build that failed, which still need
+        # to be reloaded by the next one
+        self._unloaded = set()
+        self._thread = None
+
+    def start(self):
+        """starts checking for changes every interval seconds"""
+        self._thread = threading.Thread(target=self._run, name="bunny1-reloader")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+    def _modules(self):
+        """(source path, module) for the modules the commands and
+        decorators classes come from, base classes first"""
+        modules = []
+        for obj in (self.b1.commands, self.b1.decorators):
+            for cls in reversed(type(obj).__mro__):
+                module = sys.modules.get(cls.__module__)
+                path = source_path(module)
+                if path and module is not sys.modules[__name__] and (path, module) not in modules:
+                    modules.append((path, module))
+        return modules
+
+    def _scan(self):
+        stats = {}
+        for (path, module) in self._modules():
+            try:
+                st = os.stat(path)
+                stats[path] = (st.st_mtime, st.st_size)
+            except OSError:
+                stats[path] = None
+        return stats
+
+    def check(self):
+        """reloads if any of the watched files have changed.  returns True
+        if new commands were swapped in."""
+        stats = self._scan()
+        changed = [path for path in stats if stats[path] != self._stats.get(path)]
+        if not changed:
+            return False
+        # a broken file isn't tried again until it changes again
+        self._stats = stats
+        try:
+            state = self.build(self._unloaded.union(changed))
+        except Exception:
+            self._unloaded.update(changed)
+            self.errors += 1
+            print >> sys.stderr, "bunny1: not reloading commands because of this error:"
+            traceback.print_exc()
+            return False
+        self.swap(state)
+        self._unloaded.clear()
+        print >> sys.stderr, "bunny1: reloaded commands from %s" % ", ".join(changed)
+        return True
+
+    def build(self, changed):
+        """loads the new code and returns a CommandState made from it.
+        the modules with the commands and decorators classes are loaded as
+        new modules, and the base modules that changed are reloaded in
+        place but put back the way they were if anything goes wrong, so
+        a bad build leaves the running instance alone."""
+        modules = self._modules()
+        # make sure it all compiles before running any of it
+        for (path, module) in modules:
+            compile(open(path).read() + "\n", path, "exec")
+
+        old = self.b1.state
+        leaves = (type(old.commands).__module__, type(old.decorators).__module__)
+        self.reloads += 1
+        loaded = {}
+        # the names of the new modules, and (module, its __dict__ from
+        # before it was reloaded) for the ones reloaded in place
+        names = []
+        saved = []
+        try:
+            for (path, module) in modules:
+                if module.__name__ in leaves:
+                    # the modules with the commands and decorators classes
+                    # (which may be __main__) are loaded as new modules so
+                    # that the running ones are left alone
+                    name = "_bunny1_reload_%d_%s" % (self.reloads, os.path.splitext(os.path.basename(path))[0])
+                    names.append(name)
+                    loaded[module.__name__] = imp.load_source(name, path)
+                elif path in changed:
+                    saved.append((module, dict(module.__dict__)))
+                    reload(module)
+
+            def new(obj):
+                cls = type(obj)
+                module = loaded.get(cls.__module__) or sys.modules[cls.__module__]
+                return getattr(module, cls.__name__)()
+
+            commands = new(old.commands)
+            decorators = new(old.decorators)
+            for name in self.keep:
+                if name in old.commands.__dict__:
+                    setattr(commands, name, getattr(old.commands, name))
+            for manifest in getattr(old.commands, "_plugins", []):
+                commands.load_plugins(manifest)
+
+            table = CommandTable(commands)
+            if not table.entries:
+                raise ValueError("the reloaded %s doesn't have any commands" % type(commands).__name__)
+            # build these now instead of on the first request that needs them
+            table.index
+            table.trie
+        except:
+            for (module, namespace) in reversed(saved):
+                module.__dict__.clear()
+                module.__dict__.update(namespace)
+            for name in names:
+                sys.modules.pop(name, None)
+            raise
+        return CommandState(commands, decorators, table, tuple(loaded.values()))
+
+    def swap(self, state):
+        """makes state the running instance's commands, decorators, and
+        command table all at once"""
+        b1 = self.b1
+        state.commands._b1 = b1
+        state.decorators._b1 = b1
+        old = b1.state
+        b1.state = state
+        invalidate_pages(state.commands)
+        # requests that are already running keep the old modules alive
+        # through the old state, so they only need to be out of sys.modules
+        for module in old.modules:
+            if sys.modules.get(module.__name__) is module:
+                del sys.modules[module.__name__]
+
+class CommandState(object):
+    """the commands, decorators, and command table that a Bunny1 instance
+    resolves with, which a Reloader replaces all at once.  modules are the
+    ones a Reloader loaded them from, which are kept here so that they
+    stay alive (python 2 empties a module's globals when it goes away)
+    for as long as anything is still using these commands."""
+    __slots__ = ("commands", "decorators", "command_table", "modules")
+
+    def __init__(self, commands, decorators, command_table, modules=()):
+        self.commands = commands
+        self.decorators = decorators
+        self.command_table = command_table
+        self.modules = modules
+
+def source_path(module):
+    """the path of the .py file that module was loaded from, if there is one"""
+    path = getattr(module, "__file__", None)
+    if not path:
+        return None
+    if path.endswith((".pyc", ".pyo")):
+        path = path[:-1]
+    if not path.endswith(".py"):
+        return None
+    return os.path.abspath(path)
+
+def reuse_port_wsgi_server(server):
+    """makes the cherrypy WSGI server for server (ex. cherrypy.server), but
+    with SO_REUSEPORT set on its listening socket so that several worker
+    processes can listen on the same port"""
+    from cherrypy._cpwsgi_server import CPWSGIServer
+
+    class ReusePortWSGIServer(CPWSGIServer):
+        def bind(self, family, type, proto=0):
+            self.socket = socket.socket(family, type, proto)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            if self.nodelay and not isinstance(self.bind_addr, str):
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.socket.bind(self.bind_addr)
+
+    return ReusePortWSGIServer(server)
+
+class AsyncServer(LazyBase):
+    """a small single-threaded HTTP/1.1 server (with keep-alive) built on
+    asyncore, for bunny1's common case of a query string coming in and a
+    redirect going out.
+
+    plain GETs of / without cookies take a fast path that skips building
+    a WSGI environ and a fresh request object, since nothing about them
+    needs more than the query string.  everything else (cookies, which
+    aliases and auth depend on, POSTs, other paths) goes through the full
+    per-request setup that Bunny1.wsgi uses.
+
+    commands run on the event loop thread, so this isn't a good fit if
+    you have commands that take a long time."""
+
+    _lazy_base = (asyncore, "dispatcher")
+
+    def __init__(self, b1, host, port, reuse_port=False):
+        asyncore.dispatcher.__init__(self)
+        self.b1 = b1
+        self.host = host
+        self.port = port
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.bind((host, port))
+        self.listen(1024)
+
+        # everything happens on one thread, so the fast path can reuse
+        # the same request object for every request
+        self._request = _cprequest.Request(httputil.Host(host, port), httputil.Host("", 0))
+        self._request.path_info = "/"
+        self._request.script_name = ""
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            AsyncConnection(pair[0], pair[1], self)
+
+    def respond(self, method, target, protocol, headers, body, remote):
+        """returns (status code, header list, body) for a request"""
+        (path, sep, query) = target.partition("?")
+        if method == "GET" and path == "/" and "cookie" not in headers:
+            request = self._request
+            request.base = "http://" + headers.get("host", "%s:%s" % (self.host, self.port))
+            request.query_string = query
+            # nothing about the last request's user can carry over
+            request.cookie = Cookie.SimpleCookie()
+            request.alias_token = None
+            if protocol == "HTTP/1.0":
+                request.protocol = (1, 0)
+            else:
+                request.protocol = (1, 1)
+            request.headers = httputil.HeaderMap()
+            for (name, val) in headers.iteritems():
+                dict.__setitem__(request.headers, name.title(), val)
+            return self.b1.serve_request(request)
+
+        environ = {
+            "REQUEST_METHOD": method,
+            "PATH_INFO": urllib.unquote(path),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": protocol,
+            "REMOTE_ADDR": remote[0],
+            "REMOTE_PORT": str(remote[1]),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": StringIO(body),
+        }
+        for (name, val) in headers.iteritems():
+            if name in ("content-type", "content-length"):
+                environ[name.upper().replace("-", "_")] = val
+            else:
+                environ["HTTP_" + name.upper().replace("-", "_")] = val
+        return self.b1.serve_request(self.b1._wsgi_request(environ))
+
+class AsyncConnection(LazyBase):
+    """one client connection to an AsyncServer"""
+
+    _lazy_base = (asynchat, "async_chat")
+
+    def __init__(self, sock, addr, server):
+        asynchat.async_chat.__init__(self, sock)
+        self.server = server
+        self.addr = addr
+        self._refused = False
+        self._reset()
+
+    def _reset(self):
+        self._data = []
+        self._size = 0
+        self._head = None
+        self.set_terminator("\r\n\r\n")
+
+    def collect_incoming_data(self, data):
+        if self._refused:
+            return
+        if self._head is None:
+            self._size += len(data)
+            if self._size > ASYNC_MAX_HEADER_BYTES:
+                self._data = []
+                self._refuse(431, "Request Header Fields Too Large")
+                return
+        self._data.append(data)
+
+    def _refuse(self, code, reason=None):
+        """answers with just an error status and hangs up, for requests
+        that we won't read the rest of"""
+        self._refused = True
+        self.set_terminator(None)
+        self.push("HTTP/1.1 %d %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n" % (
+                code, reason or httplib.responses.get(code, "")))
+        self.close_when_done()
+
+    def found_terminator(self):
+        data = "".join(self._data)
+        self._data = []
+        if self._head is None:
+            lines = data.split("\r\n")
+            try:
+                (method, target, protocol) = lines[0].split(None, 2)
+            except ValueError:
+                self.close()
+                return
+            headers = {}
+            for line in lines[1:]:
+                (name, sep, val) = line.partition(":")
+                headers[name.strip().lower()] = val.strip()
+            self._head = (method, target, protocol, headers)
+            try:
+                length = int(headers.get("content-length") or 0)
+            except ValueError:
+                self._refuse(400)
+                return
+            if length > ASYNC_MAX_BODY_BYTES:
+                self._refuse(413)
+                return
+            if length > 0:
+                self.set_terminator(length)
+                return
+            body = ""
+        else:
+            body = data
+
+        (method, target, protocol, headers) = self._head
+        self._reset()
+        try:
+            (code, response_headers, response_body) = self.server.respond(
+                method, target, protocol, headers, body, self.addr)
+        except:
+            traceback.print_exc()
+            (code, response_headers, response_body) = (500, [("Content-Length", "0")], "")
+
+        connection = headers.get("connection", "").lower()
+        if protocol == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+            if keep_alive:
+                response_headers.append(("Connection", "keep-alive"))
+        if not keep_alive:
+            response_headers.append(("Connection", "close"))
+        if method == "HEAD":
+            # the headers (Content-Length included) are the same as for a
+            # GET, just without the body
+            response_body = ""
+
+        self.push("%s %d %s\r\n%s\r\n\r\n%s" % (
+                protocol, code, httplib.responses.get(code, ""),
+                "\r\n".join(["%s: %s" % h for h in response_headers]),
+                response_body))
+        if not keep_alive:
+            self.close_when_done()
+
+class StaticAsset(object):
+    """an in-memory copy of a static file and the validators sent with it"""
+    __slots__ = ("data", "content_type", "etag", "mtime", "_last_modified")
+
+    def __init__(self, data, content_type, mtime):
+        self.data = data
+        self.content_type = content_type
+        self.etag = '"%s"' % hashlib.md5(data).hexdigest()
+        self.mtime = mtime
+        self._last_modified = None
+
+    @property
+    def last_modified(self):
+        # worked out the first time it's served since email.utils is
+        # slow to import and a command line run never needs it
+        if self._last_modified is None:
+            import email.utils
+            self._last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+        return self._last_modified
+
+class AssetCache(object):
+    """static files (ex. favicon.ico) that are loaded into memory once
+    and then served with strong ETags and long cache lifetimes.
+
+    deployments can add their own with register or register_file, and
+    Bunny1 will serve them at /<name>."""
+
+    def __init__(self, max_age=ASSET_MAX_AGE):
+        self.max_age = max_age
+        self._assets = {}
+
+    def register(self, name, data, content_type, mtime=None):
+        """adds an asset with the given contents"""
+        if mtime is None:
+            mtime = time.time()
+        # replace the dict rather than changing it so that requests
+        # being served never see a half-registered asset
+        assets = dict(self._assets)
+        assets[name] = StaticAsset(data, content_type, mtime)
+        self._assets = assets
+
+    def register_file(self, name, path, content_type=None):
+        """adds an asset with the contents of the file at path"""
+        if content_type is None:
+            import mimetypes
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        f = open(path, "rb")
+        try:
+            data = f.read()
+            mtime = os.fstat(f.fileno()).st_mtime
+        finally:
+            f.close()
+        self.register(name, data, content_type, mtime)
+
+    def __contains__(self, name):
+        return name in self._assets
+
+    def get(self, name):
+        """returns the StaticAsset registered under name or None"""
+        return self._assets.get(name)
+
+    def serve(self, name):
+        """sends the named asset, or a 304 if the browser already has it"""
+        asset = self._assets.get(name)
+        if asset is None:
+            raise cherrypy.NotFound()
+        headers = cherrypy.response.headers
+        headers["Content-Type"] = asset.content_type
+        headers["ETag"] = asset.etag
+        headers["Last-Modified"] = asset.last_modified
+        headers["Cache-Control"] = "public, max-age=%d" % self.max_age
+        if etag_matches(asset.etag, cherrypy.request.headers.get("If-None-Match")):
+            cherrypy.response.status = 304
+            return ""
+        return asset.data
+
+def etag_matches(etag, if_none_match):
+    """tells whether an If-None-Match header value matches etag"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag == etag:
+            return True
+    return False
+
+class LRUCache(object):
+    """a thread-safe mapping that holds at most maxsize entries, throwing
+    away the least recently used ones first, and that optionally expires
+    entries ttl seconds after they were put in"""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """returns the value for key, or default if it's missing or expired"""
+        self._lock.acquire()
+        try:
+            try:
+                (value, expires) = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            # re-inserting moves it to the most recently used end
+            self._data[key] = (value, expires)
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, ttl=None):
+        """sets the value for key, expiring it after ttl (or self.ttl) seconds"""
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is None:
+            expires = None
+        else:
+            expires = time.time() + ttl
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def pop(self, key, default=None):
+        """removes key and returns its value"""
+        self._lock.acquire()
+        try:
+            try:
+                return self._data.pop(key)[0]
+            except KeyError:
+                return default
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """throws away everything in the cache"""
+        self._lock.acquire()
+        try:
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+class PageCache(object):
+    """rendered pages (ex. help and list) keyed by page, argument, and the
+    URL they were requested at.  cached pages get an ETag so that browsers
+    that already have them get a 304.
+
+    call invalidate when something a page depends on changes."""
+
+    def __init__(self, maxsize=256):
+        self._pages = LRUCache(maxsize)
+        self._generations = {}
+
+    def invalidate(self, page=None):
+        """forgets the cached copies of page, or of every page if page is None"""
+        if page is None:
+            self._pages.clear()
+        else:
+            # stale entries just stop being looked up and eventually
+            # fall out of the LRU
+            self._generations[page] = self._generations.get(page, 0) + 1
+
+    def render(self, page, arg, render, vary=None):
+        """returns the cached Content for page and arg, calling render to
+        produce it if it isn't cached yet.  vary is anything else the page
+        depends on."""
+        key = (page, self._generations.get(page, 0), arg, vary,
+               cherrypy.request.base + cherrypy.request.path_info)
+        content = self._pages.get(key)
+        if content is None:
+            try:
+                content = render()
+            except Content, content:
+                pass
+            if not isinstance(content, Content):
+                # pages that redirect instead of showing content aren't cached
+                return content
+            content.etag = '"%s"' % hashlib.md5(content.content_type + "\n" + content.html).hexdigest()
+            self._pages.put(key, content)
+        return content
+
+def invalidate_pages(commands):
+    """forgets the pages commands has cached (see cached_page), ex. after
+    its commands have changed"""
+    page_cache = getattr(commands, "_page_cache", None)
+    if page_cache is not None:
+        page_cache.invalidate()
+
+def cached_page(page, vary=None):
+    """decorator for commands that show a page that only depends on the
+    argument given (and on vary(self, arg), if given), so that the page
+    can be rendered once and then served from the page cache"""
+    def decorator(fun):
+        def cached(self, arg):
+            if vary:
+                extra = vary(self, arg)
+            else:
+                extra = None
+            return self._page_cache.render(page, arg, lambda: fun(self, arg), extra)
+        cached.__name__ = fun.__name__
+        cached.__doc__ = fun.__doc__
+        cached.__dict__.update(fun.__dict__)
+        return cached
+    return decorator
+
+def is_decorator(d):
+    """tells whether d is something that can be used as an @decorator"""
+    return d is not None and getattr(d, "exposed", False)
+
+class DecoratorChain(object):
+    """a run of @decorators (ex. @archive @co.uk) looked up once and put
+    together into apply, which runs a URL through all of them, last one
+    first.  a decorator can return a Redirect (whose URL goes on to the
+    next one) or Content (which is the result, skipping the rest)."""
+
+    def __init__(self, owner, funs):
+        # the decorators object the funs came from, so that chains from
+        # one that has since been replaced (ex. by a Reloader) aren't used
+        self.owner = owner
+        self.funs = tuple(funs)
+        if len(funs) == 1:
+            self.apply = funs[0]
+        else:
+            funs = funs[::-1]
+            def apply(url):
+                for fun in funs:
+                    url = fun(url)
+                    if isinstance(url, Redirect):
+                        url = url.url
+                    elif isinstance(url, Content):
+                        break
+                return url
+            self.apply = apply
+
+class WorkerPool(object):
+    """a fixed set of daemon threads that run functions handed to them.
+    the threads are started the first time they're needed (and again in
+    a forked child, which only has the thread that forked) and then live
+    as long as the process, so the per thread shards that counters and
+    histograms keep don't pile up the way they would if every caller
+    started threads of its own."""
+
+    def __init__(self, num_threads, name="bunny1-worker"):
+        self.num_threads = num_threads
+        self.name = name
+        self._work = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        """makes sure all num_threads threads are running"""
+        self._lock.acquire()
+        try:
+            self._threads = [thread for thread in self._threads if thread.isAlive()]
+            while len(self._threads) < self.num_threads:
+                thread = threading.Thread(target=self._run, name=self.name)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            (fun, args) = self._work.get()
+            try:
+                fun(*args)
+            except Exception:
+                cherrypy.log("error in %s" % self.name, traceback=True)
+
+    def submit(self, fun, *args):
+        """calls fun(*args) on one of the pool's threads without waiting
+        for it"""
+        self._start()
+        self._work.put((fun, args))
+
+    def run_all(self, fun, args_list):
+        """calls fun(*args) for each args in args_list on the pool's
+        threads and returns once they have all returned"""
+        self._start()
+        finished = Queue.Queue()
+        def call(args):
+            try:
+                fun(*args)
+            finally:
+                finished.put(None)
+        for args in args_list:
+            self._work.put((call, (args,)))
+        for args in args_list:
+            finished.get()
+
+# the threads that big batches are resolved on (see Bunny1.batch)
+batch_pool = WorkerPool(BATCH_THREADS, "bunny1-batch")
+
+class Redirect(object):
+    """return this from a command to redirect to url.  returning the URL
+    itself does the same thing.  unlike raising HTTPRedirect, nothing has
+    to be raised and caught to send a Redirect."""
+    __slots__ = ("url",)
+
+    def __init__(self, url):
+        self.url = url
+
+    def __repr__(self):
+        return "Redirect(%r)" % (self.url,)
+
+def body_result(body):
+    """turns a page body (or a result) into a result"""
+    if isinstance(body, (Redirect, Content)):
+        return body
+    return Content(body or "")
+
+def parse_batch(body):
+    """the commands in a batch: a JSON list of strings, or one per line"""
+    text = body.strip()
+    if text.startswith("["):
+        raws = json.loads(text)
+        for raw in raws:
+            if not isinstance(raw, basestring):
+                raise ValueError("a batch has to be a list of strings")
+        raws = [raw.encode("utf-8") for raw in raws]
+    else:
+        raws = [line.strip() for line in text.splitlines() if line.strip()]
+    if len(raws) > MAX_BATCH_SIZE:
+        raise ValueError("a batch can have at most %d commands" % MAX_BATCH_SIZE)
+    return raws
+
+def request_body(limit):
+    """reads the body of the current request, which can't be more than
+    limit bytes"""
+    request = cherrypy.request
+    try:
+        length = int(request.headers.get("Content-Length") or 0)
+    except ValueError:
+        raise cherrypy.HTTPError(400)
+    if length > limit:
+        raise cherrypy.HTTPError(413)
+    if request.rfile is None or not length:
+        return ""
+    return request.rfile.read(length)
+
+# matches the scheme at the start of an absolute URL
+URL_SCHEME_RE = re.compile(r"^[a-zA-Z][a-zA-Z0-9+.-]*:")
+
+def absolute_url(url):
+    """makes url absolute relative to the current request, like HTTPRedirect does"""
+    if isinstance(url, unicode):
+        url = url.encode("utf-8")
+    if URL_SCHEME_RE.match(url):
+        return url
+    return urlparse.urljoin(cherrypy.url(), url)
+
 class Content(Exception):
-    """raise when returning content instead of redirecting"""
+    """return (or raise) when returning content instead of redirecting"""
+
+    # set on content that comes out of the page cache
+    etag = None
+
     def __init__(self, html="", content_type="text/html"):
         self.content_type = content_type
         self.html = html
@@ -309,13 +1862,1496 @@ def no_auth_required(fun):
     fun.no_auth_required = True
     return fun
 
+def cacheable(ttl=None, maxsize=1024):
+    """decorator for commands (and bunny1 decorators) whose result only
+    depends on their argument, so that it can be remembered for ttl
+    seconds or until it falls out of the maxsize most recently used.
+    looking something up in the cache takes a few microseconds, so this
+    is for commands that do real work (ex. a directory lookup), not ones
+    that just fill in a URL.  _cache shows stats and flushes the caches."""
+    def decorator(fun):
+        cache = LRUCache(maxsize, ttl)
+        missing = object()
+        def cached(*args):
+            # args is (self, arg) for methods and (arg,) for plain functions,
+            # so keying on all of it keeps each instance's results apart
+            result = cache.get(args, missing)
+            if result is missing:
+                try:
+                    result = fun(*args)
+                except Content, content:
+                    result = content
+                except cherrypy.HTTPRedirect, redir:
+                    result = Redirect(redir.urls[0])
+                cache.put(args, result)
+            return result
+        cached.__name__ = fun.__name__
+        cached.__doc__ = fun.__doc__
+        cached.__dict__.update(fun.__dict__)
+        cached.cache = cache
+        return cached
+    return decorator
+
+class CommandEntry(object):
+    """everything do_command needs to know to run a single command"""
+    __slots__ = ("name", "fun", "no_auth_required", "preprocessor", "unlisted", "doc")
+
+    def __init__(self, name, fun):
+        self.name = name
+        self.fun = fun
+        self.no_auth_required = getattr(fun, "no_auth_required", False)
+        preprocessor = getattr(fun, "preprocessor", None)
+        if not callable(preprocessor):
+            preprocessor = None
+        self.preprocessor = preprocessor
+        self.unlisted = getattr(fun, "unlisted", False)
+        self.doc = fun.__doc__
+
+def command_entry(commands, name):
+    """returns a CommandEntry for the named command or None if there
+    isn't an exposed, callable command with that name"""
+    if name.startswith("__"):
+        return None
+    try:
+        fun = getattr(commands, name)
+    except AttributeError:
+        return None
+    if getattr(fun, "dont_expose", False) or not callable(fun):
+        return None
+    return CommandEntry(name, fun)
+
+class LazyCommand(object):
+    """a command from a plugin module that isn't imported until the first
+    time it's used.  until then, everything that bunny1 needs to know
+    about it without running it (its doc and whether it's unlisted or
+    doesn't need auth) comes from the plugin manifest (see load_plugins).
+
+    plugin commands are functions in the plugin module that take the
+    same (self, arg) arguments that methods of Bunny1Commands do."""
+
+    def __init__(self, commands, module, name, doc=None, unlisted=False, no_auth_required=False):
+        self.commands = commands
+        self.module = module
+        self.name = name
+        self.__doc__ = doc
+        self.unlisted = unlisted
+        self.no_auth_required = no_auth_required
+        self._fun = None
+
+    def load(self):
+        """imports the plugin module and returns the command function"""
+        if self._fun is None:
+            __import__(self.module)
+            self._fun = getattr(sys.modules[self.module], self.name)
+        return self._fun
+
+    def __call__(self, arg):
+        try:
+            fun = self.load()
+        except (ImportError, AttributeError), e:
+            return ErrorMesage("couldn't load %s from %s: %s" % (self.name, self.module, e))
+        if callable(getattr(fun, "preprocessor", None)):
+            arg = fun.preprocessor(arg)
+        return fun(self.commands, arg)
+
+    def __repr__(self):
+        return "<LazyCommand %s from %s>" % (self.name, self.module)
+
+def plugin_manifest(module_names):
+    """imports the named plugin modules and returns a manifest for them
+    that load_plugins can use without importing them.  the commands in a
+    module are the functions in its __all__ or, if it doesn't have one,
+    all of the functions defined in it that don't start with _."""
+    manifest = {}
+    for module_name in module_names:
+        __import__(module_name)
+        module = sys.modules[module_name]
+        names = getattr(module, "__all__", None)
+        if names is None:
+            names = [name for name in dir(module) if not name.startswith("_") and
+                     getattr(getattr(module, name), "__module__", None) == module_name]
+        commands = {}
+        for name in names:
+            fun = getattr(module, name)
+            if not callable(fun) or getattr(fun, "dont_expose", False):
+                continue
+            info = {"doc": fun.__doc__}
+            for flag in ("unlisted", "no_auth_required"):
+                if getattr(fun, flag, False):
+                    info[flag] = True
+            commands[name] = info
+        manifest[module_name] = commands
+    return manifest
+
+def write_plugin_manifest(path, module_names):
+    """writes the plugin_manifest for module_names to path as JSON.  run
+    this when plugins change (ex. as part of a deploy), not at startup."""
+    f = open(path, "w")
+    try:
+        json.dump(plugin_manifest(module_names), f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+
+class CommandTable(object):
+    """a dispatch table built once from a commands object that maps each
+    exposed command name and alias (ex. ls and commands -> list) to its
+    CommandEntry, so that looking up a command is a single dict hit
+    instead of a round of reflection on every request"""
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.entries = {}
+        for name in dir(commands):
+            entry = command_entry(commands, name)
+            if entry is not None:
+                self.entries[name] = entry
+
+        # commands classes that make up commands on the fly with
+        # __getattr__ can't be fully enumerated ahead of time, so we
+        # still do the slow lookup for those when the table misses
+        self._dynamic = hasattr(type(commands), "__getattr__")
+
+        self._index = None
+        self._trie = None
+        self._build_lock = threading.Lock()
+
+    def _build_once(self, attr, build):
+        # indexes are only built the first time they're needed so that
+        # big catalogs don't slow down startup
+        built = getattr(self, attr)
+        if built is None:
+            self._build_lock.acquire()
+            try:
+                built = getattr(self, attr)
+                if built is None:
+                    built = build(self.entries.values())
+                    setattr(self, attr, built)
+            finally:
+                self._build_lock.release()
+        return built
+
+    index = property(lambda self: self._build_once("_index", CommandIndex),
+                     doc="the CommandIndex for the listed commands in this table")
+    trie = property(lambda self: self._build_once("_trie", CommandTrie),
+                    doc="the CommandTrie for completing the names of listed commands")
+
+    def lookup(self, name):
+        """returns the CommandEntry for name or None"""
+        entry = self.entries.get(name)
+        if entry is None and self._dynamic:
+            entry = command_entry(self.commands, name)
+        return entry
+
+class CommandIndex(object):
+    """a search index over the commands that list shows.
+
+    command names (lowercased) and docstrings are broken up into every
+    1, 2, and 3 character substring, and each of those maps to the set of
+    commands that contain it.  a search intersects the sets for the
+    query's substrings and then checks the few candidates that are left,
+    so it finds exactly what a substring test against every command would
+    find without having to look at every command."""
+
+    GRAM_SIZE = 3
+
+    def __init__(self, entries):
+        listed = [(entry.name, entry.doc) for entry in entries if entry.doc and not entry.unlisted]
+        listed.sort()
+        self.listed = listed
+        self._lower_names = [name.lower() for (name, doc) in listed]
+        self._name_grams = {}
+        self._doc_grams = {}
+        self._words = {}
+        for (i, (name, doc)) in enumerate(listed):
+            self._add_grams(self._name_grams, name.lower(), i)
+            # docstrings are searched case-sensitively, just like list
+            # always has
+            self._add_grams(self._doc_grams, doc, i)
+            for word in re.findall(r"\w+", doc.lower()):
+                self._words.setdefault(word, set()).add(i)
+
+    def _add_grams(self, grams, text, i):
+        for n in xrange(1, self.GRAM_SIZE + 1):
+            for start in xrange(len(text) - n + 1):
+                grams.setdefault(text[start:start + n], set()).add(i)
+
+    def _candidates(self, grams, query):
+        """the set of ids whose text might contain query"""
+        if len(query) <= self.GRAM_SIZE:
+            # an exact hit since the query is itself one of the grams
+            return grams.get(query, set())
+        n = self.GRAM_SIZE
+        postings = [grams.get(query[start:start + n], set()) for start in xrange(len(query) - n + 1)]
+        postings.sort(key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def search(self, query):
+        """returns (name, doc) pairs for the listed commands whose name or
+        docstring contains query, best matches first"""
+        query = query.lower()
+        if not query:
+            return list(self.listed)
+        # candidates only need to be checked if the query is longer than
+        # the grams, otherwise they are exact
+        verify = len(query) > self.GRAM_SIZE
+        lower_names = self._lower_names
+        words = self._words.get(query, ())
+        ranked = []
+        in_name = set()
+        for i in self._candidates(self._name_grams, query):
+            name_lower = lower_names[i]
+            if verify and query not in name_lower:
+                continue
+            if name_lower == query:
+                rank = 0
+            elif name_lower.startswith(query):
+                rank = 1
+            else:
+                rank = 2
+            ranked.append((rank, name_lower, i))
+            in_name.add(i)
+        listed = self.listed
+        for i in self._candidates(self._doc_grams, query).difference(in_name):
+            if verify and query not in listed[i][1]:
+                continue
+            if i in words:
+                rank = 3
+            else:
+                rank = 4
+            ranked.append((rank, lower_names[i], i))
+        ranked.sort()
+        return [listed[i] for (rank, name_lower, i) in ranked]
+
+class CommandTrie(object):
+    """a prefix trie over the names of listed commands (and their aliases)
+    for completing partially typed commands.
+
+    the names are kept in one sorted list and each node of the trie holds
+    the range of that list that starts with its prefix, so the completions
+    for a prefix are found by walking one node per character."""
+
+    # each node is [children, start, end]
+    def __init__(self, entries):
+        self.names = sorted([entry.name for entry in entries if not entry.unlisted])
+        self._root = [{}, 0, len(self.names)]
+        for (i, name) in enumerate(self.names):
+            node = self._root
+            for c in name:
+                child = node[0].get(c)
+                if child is None:
+                    child = node[0][c] = [{}, i, i]
+                child[2] = i + 1
+                node = child
+        # (start, end, limit) -> (popularity version, ranked names)
+        self._ranked = {}
+
+    def complete(self, prefix, popularity=None, limit=10):
+        """returns up to limit names that start with prefix, most
+        popular first (or alphabetically if there's no popularity)"""
+        node = self._root
+        for c in prefix:
+            node = node[0].get(c)
+            if node is None:
+                return []
+        (start, end) = (node[1], node[2])
+        if popularity is None:
+            return self.names[start:min(end, start + limit)]
+
+        (version, counts) = popularity.snapshot()
+        key = (start, end, limit)
+        ranked = self._ranked.get(key)
+        if ranked is None or ranked[0] != version:
+            names = self.names[start:end]
+            top = heapq.nlargest(limit, xrange(len(names)),
+                                 key=lambda i: (counts.get(names[i], 0), -i))
+            ranked = (version, [names[i] for i in top])
+            self._ranked[key] = ranked
+        return ranked[1]
+
+class History(object):
+    """a fixed-size ring buffer of the most recent queries made to this
+    server and the times they were made.  appending is O(1) and memory
+    stays flat no matter how long the server runs."""
+
+    def __init__(self, size=DEFAULT_HISTORY_SIZE):
+        self.size = size
+        self._entries = [None] * size
+        self._times = array.array("d", [0.0]) * size
+        # itertools.count hands out slots atomically so concurrent
+        # appends from different threads don't need a lock
+        self._tickets = itertools.count()
+        self._appended = 0
+        # callables that return lists of (time, query) pairs, newest
+        # first, kept somewhere else (ex. in other worker processes)
+        self.sources = []
+
+    def append(self, raw, when=None):
+        """records a query"""
+        if when is None:
+            when = time.time()
+        if type(raw) is str:
+            # the same handful of queries show up over and over
+            raw = intern(raw)
+        n = self._tickets.next()
+        i = n % self.size
+        self._entries[i] = raw
+        self._times[i] = when
+        self._appended = n + 1
+
+    def __len__(self):
+        return min(self._appended, self.size)
+
+    def last_timed(self, num=None):
+        """returns a list of (time, query) pairs for the num most recent
+        queries, newest first"""
+        entries = self.local_last_timed(num)
+        if self.sources:
+            for source in self.sources:
+                entries.extend(source())
+            entries.sort(reverse=True)
+            if num is None:
+                num = self.size
+            del entries[num:]
+        return entries
+
+    def local_last_timed(self, num=None):
+        """like last_timed but only for queries made in this process"""
+        count = len(self)
+        if num is None or num > count:
+            num = count
+        entries = self._entries
+        times = self._times
+        size = self.size
+        end = self._appended
+        return [(times[i % size], entries[i % size]) for i in xrange(end - 1, end - 1 - num, -1)]
+
+    def last(self, num=None):
+        """returns a list of the num most recent queries, newest first"""
+        return [raw for (when, raw) in self.last_timed(num)]
+
+    def __iter__(self):
+        """iterates over the remembered queries, oldest first"""
+        return reversed(self.last())
+
+    def __getitem__(self, index):
+        entries = self.last()
+        entries.reverse()
+        return entries[index]
+
+class Outcomes(object):
+    """the ways that resolving a command can turn out, for metrics"""
+    REDIRECT = "redirect"
+    CONTENT = "content"
+    FALLBACK = "fallback"
+    UNAUTHORIZED = "unauthorized"
+    ERROR = "error"
+    ALL = (REDIRECT, CONTENT, FALLBACK, UNAUTHORIZED, ERROR)
+
+class LatencyHistogram(object):
+    """counts how long things take in buckets, per key.  like
+    ShardedCounter, each thread writes to its own shard so that there is
+    no lock on the hot path, and the shards are merged when reading."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        # (thread, shard) pairs for every thread that has observed something
+        self._shards = []
+        # histograms from threads that have gone away
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = {}
+        self._lock.acquire()
+        try:
+            # threads can come and go without anyone reading (ex. a WSGI
+            # container with a thread per request), so dead threads'
+            # shards are folded in here too, not just when reading
+            self._retire()
+            self._shards.append((threading.currentThread(), shard))
+        finally:
+            self._lock.release()
+        self._local.shard = shard
+        return shard
+
+    def observe(self, key, seconds):
+        """counts something for key that took seconds"""
+        try:
+            counts = self._local.shard[key]
+        except AttributeError:
+            # a count per bucket, one for anything slower, then the total time
+            counts = self._shard()[key] = [0] * (len(self.buckets) + 2)
+        except KeyError:
+            counts = self._local.shard[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, seconds)] += 1
+        counts[-1] += seconds
+
+    def merged(self):
+        """returns a dict of key -> [count per bucket..., count of slower
+        ones, total seconds] with all the shards merged together"""
+        self._lock.acquire()
+        try:
+            live = self._retire()
+            merged = {}
+            _merge_histograms(merged, self._retired)
+        finally:
+            self._lock.release()
+        for (thread, shard) in live:
+            _merge_histograms(merged, shard)
+        return merged
+
+    def _retire(self):
+        """folds the shards of threads that have gone away into _retired
+        and returns the live ones.  the caller must hold _lock."""
+        live = []
+        for (thread, shard) in self._shards:
+            if thread.isAlive():
+                live.append((thread, shard))
+            else:
+                _merge_histograms(self._retired, shard)
+        self._shards = live
+        return live
+
+def _merge_histograms(into, histograms):
+    for (key, counts) in histograms.items():
+        total = into.get(key)
+        if total is None:
+            into[key] = list(counts)
+        else:
+            for (i, count) in enumerate(counts):
+                total[i] += count
+
+def prometheus_escape(value):
+    """escapes a label value for prometheus' text format"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class SamplingProfiler(object):
+    """samples the stacks of all the other threads every interval seconds
+    for a while and counts how often each stack shows up.  the counts come
+    out as collapsed stacks (one "frame;frame;frame count" line per
+    stack), which flamegraph.pl and friends know how to draw."""
+
+    def __init__(self, interval=PROFILE_INTERVAL, max_stacks=10000):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks = {}
+        self.samples = 0
+        self.started = None
+        self.until = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def running(self):
+        return self._thread is not None and self._thread.isAlive()
+
+    def start(self, seconds=DEFAULT_PROFILE_SECONDS):
+        """throws away any old samples and samples for the next seconds.
+        if it's already running, it just keeps going for seconds more."""
+        self._lock.acquire()
+        try:
+            self.until = time.time() + seconds
+            if not self.running():
+                self.stacks = {}
+                self.samples = 0
+                self.started = time.time()
+                self._thread = threading.Thread(target=self._run, name="bunny1-profiler")
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        """stops sampling and waits for the sampling thread to finish"""
+        self.until = 0
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        me = threading.currentThread().ident
+        stacks = self.stacks
+        while time.time() < self.until:
+            names = dict([(t.ident, t.getName()) for t in threading.enumerate()])
+            for (ident, frame) in sys._current_frames().items():
+                if ident == me or is_idle_frame(frame):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread %d" % ident))
+                stack.reverse()
+                key = ";".join(stack)
+                if key in stacks or len(stacks) < self.max_stacks:
+                    stacks[key] = stacks.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        """the collapsed stacks, most common first"""
+        pairs = sorted(self.stacks.items(), key=lambda pair: -pair[1])
+        return "".join(["%s %d\n" % (stack, count) for (stack, count) in pairs])
+
+def is_idle_frame(frame):
+    """tells whether a thread is just waiting around for something to do
+    (ex. a server thread waiting for a request), which isn't interesting
+    to profile"""
+    code = frame.f_code
+    return code.co_name == "wait" and os.path.basename(code.co_filename).startswith("threading.py")
+
+class MemorySnapshots(object):
+    """takes snapshots of what's using memory and diffs them.  this uses
+    tracemalloc when it's around, and otherwise counts the live objects
+    of each type that the garbage collector knows about."""
+
+    def __init__(self):
+        self.previous = None
+
+    def take(self):
+        if tracemalloc:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+            return tracemalloc.take_snapshot()
+        types = {}
+        for obj in gc.get_objects():
+            cls = type(obj)
+            (count, size) = types.get(cls, (0, 0))
+            types[cls] = (count + 1, size + sys.getsizeof(obj, 0))
+        return types
+
+    def snapshot(self):
+        """takes a snapshot to diff later ones against"""
+        self.previous = self.take()
+
+    def diff(self, limit=MEMORY_DIFF_LINES):
+        """takes a snapshot and returns a report of what grew the most
+        since the last one, or None if there wasn't a last one"""
+        (previous, current) = (self.previous, self.take())
+        self.previous = current
+        if previous is None:
+            return None
+        if tracemalloc:
+            return "".join(["%s\n" % stat for stat in current.compare_to(previous, "lineno")[:limit]])
+        lines = []
+        for cls in current:
+            (count, size) = current[cls]
+            (old_count, old_size) = previous.get(cls, (0, 0))
+            if count != old_count or size != old_size:
+                lines.append((size - old_size, count - old_count, cls, count, size))
+        for cls in previous:
+            if cls not in current:
+                (old_count, old_size) = previous[cls]
+                lines.append((-old_size, -old_count, cls, 0, 0))
+        lines.sort(key=lambda line: -abs(line[0]))
+        return "".join(["%+d bytes %+d objects %s.%s (now %d objects, %d bytes)\n" % (
+            size_diff, count_diff, cls.__module__, cls.__name__, count, size) for
+            (size_diff, count_diff, cls, count, size) in lines[:limit]])
+
+    def stop(self):
+        """forgets the last snapshot and stops tracing allocations"""
+        self.previous = None
+        if tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+class ShardedCounter(object):
+    """counts things from lots of threads at once without losing counts
+    and without a global lock on the hot path.  each thread increments
+    its own shard and the shards are merged together when counts are read."""
+
+    def __init__(self):
+        self._local = threading.local()
+        # (thread, shard) pairs for every thread that has counted something
+        self._shards = []
+        # counts from threads that have gone away
+        self._retired = {}
+        # only taken when a new thread shows up or when reading
+        self._lock = threading.Lock()
+        self._snapshot = (0, {}, 0)
+        # callables that return dicts of counts kept somewhere else (ex.
+        # in other worker processes) that get merged in when reading
+        self.sources = []
+
+    def _shard(self):
+        shard = {}
+        self._lock.acquire()
+        try:
+            # threads can come and go without anyone reading (ex. a WSGI
+            # container with a thread per request), so dead threads'
+            # shards are folded in here too, not just when reading
+            self._retire()
+            self._shards.append((threading.currentThread(), shard))
+        finally:
+            self._lock.release()
+        self._local.shard = shard
+        return shard
+
+    def incr(self, key, n=1):
+        """adds n to the count for key"""
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shard()
+        shard[key] = shard.get(key, 0) + n
+
+    def counts(self):
+        """returns a dict of all the counts merged together"""
+        merged = self.local_counts()
+        for source in self.sources:
+            _merge_counts(merged, source())
+        return merged
+
+    def local_counts(self):
+        """returns a dict of the counts made in this process"""
+        self._lock.acquire()
+        try:
+            live = self._retire()
+            merged = dict(self._retired)
+        finally:
+            self._lock.release()
+        for (thread, shard) in live:
+            _merge_counts(merged, shard)
+        return merged
+
+    def _retire(self):
+        """folds the shards of threads that have gone away into _retired
+        and returns the live ones.  the caller must hold _lock."""
+        live = []
+        for (thread, shard) in self._shards:
+            if thread.isAlive():
+                live.append((thread, shard))
+            else:
+                # nobody writes to a dead thread's shard anymore, so
+                # we can fold it in for good
+                _merge_counts(self._retired, shard)
+        self._shards = live
+        return live
+
+    def snapshot(self, max_age=POPULARITY_MAX_AGE):
+        """returns (version, counts) where counts is a merged dict of the
+        counts that may be up to max_age seconds old.  this is for readers
+        that look at counts very often and don't need them to be exact.
+        the version changes whenever the counts are refreshed."""
+        (version, counts, when) = self._snapshot
+        now = time.time()
+        if now - when > max_age:
+            counts = self.counts()
+            version += 1
+            self._snapshot = (version, counts, now)
+        return (version, counts)
+
+    def get(self, key, default=0):
+        return self.counts().get(key, default)
+
+    def __getitem__(self, key):
+        return self.counts()[key]
+
+    def __contains__(self, key):
+        return key in self.counts()
+
+    def __len__(self):
+        return len(self.counts())
+
+    def items(self):
+        return self.counts().items()
+
+    def keys(self):
+        return self.counts().keys()
+
+    def most_common(self, num=None, exclude=(), max_age=None):
+        """returns a list of (count, key) pairs, highest counts first.  if
+        max_age is given, the counts come from snapshot(max_age)."""
+        if max_age is None:
+            counts = self.counts()
+        else:
+            counts = self.snapshot(max_age)[1]
+        pairs = [(val, key) for (key, val) in counts.iteritems() if key not in exclude]
+        pairs.sort()
+        pairs.reverse()
+        if num:
+            pairs = pairs[:num]
+        return pairs
+
+def _merge_counts(into, counts):
+    # items() makes a copy atomically so this is safe even while the
+    # owning thread keeps counting
+    for (key, val) in counts.items():
+        into[key] = into.get(key, 0) + val
+
+class UsageLog(object):
+    """a durable, append-only record of history and popularity so that
+    they survive restarts and are available in cgi mode.
+
+    records are written to the log file in batches by a background thread
+    so that do_command never waits on the disk.  every so often the log
+    is compacted into a snapshot file (path + ".snapshot") that holds just
+    the popularity counts and the most recent history, and the log is
+    truncated.  both files are read back with mmap at startup.
+
+    every record in either file is packed the same way: a double (a
+    timestamp, or a count for snapshotted popularity), a one character
+    kind, and a length-prefixed string.
+
+    at most max_queue records wait to be written; if the disk can't keep
+    up, more are dropped (and counted in dropped) rather than piling up
+    in memory."""
+
+    # record kinds
+    QUERY = "h"
+    USE = "p"
+    COUNT = "c"
+
+    def __init__(self, path, history_size=DEFAULT_HISTORY_SIZE,
+                 flush_interval=1.0, snapshot_interval=60 * 60,
+                 snapshot_bytes=1024 * 1024, max_queue=100000):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.history_size = history_size
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_bytes = snapshot_bytes
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._queue = Queue.Queue(max_queue)
+        self._drop_lock = threading.Lock()
+        self._thread = None
+        self._last_snapshot = time.time()
+        # serializes writers within this process; flock takes care of
+        # other processes (ex. other cgi invocations)
+        self._write_lock = threading.Lock()
+
+    def load(self, history, popularity):
+        """replays the snapshot and the log into history and popularity"""
+        f = self._open_log()
+        try:
+            _flock(f, LOCK_EX)
+            try:
+                # a record that was only partly written (ex. because of a
+                # crash) would throw off everything appended after it
+                end = complete_usage_records_length(self.path)
+                if end < os.fstat(f.fileno()).st_size:
+                    os.ftruncate(f.fileno(), end)
+                for path in (self.snapshot_path, self.path):
+                    for (num, kind, text) in read_usage_records(path):
+                        if kind == self.QUERY:
+                            history.append(text, num)
+                        elif kind == self.USE:
+                            popularity.incr(text)
+                        elif kind == self.COUNT:
+                            popularity.incr(text, int(num))
+            finally:
+                _flock(f, LOCK_UN)
+        finally:
+            f.close()
+
+    def start(self):
+        """starts the background thread that writes records to disk"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="bunny1-usage-log")
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def after_fork(self):
+        """call this in a child process that was forked after the log was
+        started, since the writer thread doesn't survive the fork"""
+        self._queue = Queue.Queue(self.max_queue)
+        self._drop_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self.start()
+
+    def record_query(self, raw):
+        """logs a query that was made to this server"""
+        self._put((time.time(), self.QUERY, raw or ""))
+
+    def record_use(self, method):
+        """logs a use of a command"""
+        self._put((time.time(), self.USE, method))
+
+    def _put(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self._drop_lock.acquire()
+            try:
+                self.dropped += 1
+            finally:
+                self._drop_lock.release()
+
+    def flush(self):
+        """writes any pending records to disk, and compacts the log into
+        the snapshot if it's time to"""
+        records = []
+        try:
+            while True:
+                records.append(self._queue.get_nowait())
+        except Queue.Empty:
+            pass
+        if not records:
+            return
+        self._write_lock.acquire()
+        try:
+            f = self._open_log()
+            try:
+                _flock(f, LOCK_EX)
+                try:
+                    f.write("".join([pack_usage_record(*r) for r in records]))
+                    f.flush()
+                    os.fsync(f.fileno())
+                    size = os.fstat(f.fileno()).st_size
+                    if (size > self.snapshot_bytes or
+                        time.time() - self._last_snapshot > self.snapshot_interval):
+                        self._compact(f)
+                finally:
+                    _flock(f, LOCK_UN)
+            finally:
+                f.close()
+        finally:
+            self._write_lock.release()
+
+    def close(self):
+        """writes out everything that is still pending"""
+        self.flush()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except (IOError, OSError), e:
+                print >> sys.stderr, "bunny1: couldn't write usage log %s: %s" % (self.path, e)
+
+    def _open_log(self):
+        return open(self.path, "ab")
+
+    def _compact(self, log):
+        """folds the log into a new snapshot and truncates the log.
+        the caller must hold an exclusive lock on log."""
+        counts = {}
+        queries = collections.deque(maxlen=self.history_size)
+        for path in (self.snapshot_path, self.path):
+            for (num, kind, text) in read_usage_records(path):
+                if kind == self.QUERY:
+                    queries.append((num, text))
+                elif kind == self.USE:
+                    counts[text] = counts.get(text, 0) + 1
+                elif kind == self.COUNT:
+                    counts[text] = counts.get(text, 0) + int(num)
+
+        chunks = [pack_usage_record(count, self.COUNT, method) for (method, count) in counts.iteritems()]
+        chunks += [pack_usage_record(when, self.QUERY, raw) for (when, raw) in queries]
+        tmp_path = "%s.%d.tmp" % (self.snapshot_path, os.getpid())
+        tmp = open(tmp_path, "wb")
+        try:
+            tmp.write("".join(chunks))
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        finally:
+            tmp.close()
+        os.rename(tmp_path, self.snapshot_path)
+        os.ftruncate(log.fileno(), 0)
+        self._last_snapshot = time.time()
+
+USAGE_RECORD = struct.Struct("!dcH")
+
+def pack_usage_record(num, kind, text):
+    """packs one usage record (see UsageLog)"""
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    text = text[:0xffff]
+    return USAGE_RECORD.pack(num, kind, len(text)) + text
+
+def complete_usage_records_length(path):
+    """returns how many bytes at the start of a usage log are whole records"""
+    end = 0
+    for (num, kind, text, end) in _read_usage_records(path):
+        pass
+    return end
+
+def read_usage_records(path):
+    """yields (num, kind, text) for each usage record in a file"""
+    for (num, kind, text, end) in _read_usage_records(path):
+        yield (num, kind, text)
+
+def _read_usage_records(path):
+    """yields (num, kind, text, end) for each usage record in a file,
+    where end is the offset just past the record"""
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return
+        m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            unpack_from = USAGE_RECORD.unpack_from
+            header_size = USAGE_RECORD.size
+            pos = 0
+            while pos + header_size <= size:
+                (num, kind, length) = unpack_from(m, pos)
+                pos += header_size
+                if pos + length > size:
+                    # a partially written record at the end of the log
+                    break
+                pos += length
+                yield (num, kind, m[pos - length:pos], pos)
+        finally:
+            m.close()
+    finally:
+        f.close()
+
+def _flock(f, op):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), op)
+
+class AccessLog(object):
+    """a log of every command resolved, with its name, outcome, the host
+    it redirected to, and how long it took, as one compact JSON object per
+    line.  ex.
+        {"command":"g","host":"www.google.com","ms":0.042,"outcome":"redirect","time":1287300000.1}
+
+    resolve just puts a record on a bounded queue, and a background thread
+    writes out whatever has piled up every write_interval seconds, but only
+    fsyncs every flush_interval seconds.  if the writer falls behind
+    and the queue fills up, records are dropped (and counted in dropped)
+    rather than making requests wait.  the log is rotated to path.1,
+    path.2, ... when it gets bigger than max_bytes."""
+
+    def __init__(self, path, max_queue=10000, write_interval=0.1,
+                 flush_interval=1.0, max_bytes=100 * 1024 * 1024, backups=5):
+        self.path = path
+        self.max_queue = max_queue
+        self.write_interval = write_interval
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+        self._queue = Queue.Queue(max_queue)
+        self._drop_lock = threading.Lock()
+        # keeps close (ex. at exit) from closing the file mid-write
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._file = None
+        self._synced = time.time()
+        self._dirty = False
+
+    def start(self):
+        """starts the background thread that writes records to disk"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="bunny1-access-log")
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def after_fork(self):
+        """call this in a child process that was forked after the log was
+        started, since the writer thread doesn't survive the fork"""
+        self._queue = Queue.Queue(self.max_queue)
+        self._drop_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._file = None
+        self._dirty = False
+        self.start()
+
+    def record(self, start, command, outcome, result, elapsed, raw=None):
+        """logs a command that was resolved (see Bunny1.resolve).  raw is
+        what was typed, which is only looked at to name the command for
+        fallbacks, since their command is always "" (see Bunny1._resolve)."""
+        if isinstance(result, Redirect):
+            url = result.url
+        else:
+            url = None
+        if command or outcome != Outcomes.FALLBACK:
+            raw = None
+        try:
+            self._queue.put_nowait((start, command, outcome, url, elapsed, raw))
+        except Queue.Full:
+            self._drop_lock.acquire()
+            try:
+                self.dropped += 1
+            finally:
+                self._drop_lock.release()
+
+    def flush(self):
+        """writes any pending records to disk"""
+        self._write_lock.acquire()
+        try:
+            self._drain([])
+            self._sync()
+        finally:
+            self._write_lock.release()
+
+    def close(self):
+        """writes out everything that is still pending"""
+        self._write_lock.acquire()
+        try:
+            self._drain([])
+            self._sync()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        finally:
+            self._write_lock.release()
+
+    def _run(self):
+        while True:
+            time.sleep(self.write_interval)
+            self._write_lock.acquire()
+            try:
+                self._drain([])
+                if time.time() - self._synced >= self.flush_interval:
+                    self._sync()
+            except Exception, e:
+                # the writer has to keep going whatever happens
+                print >> sys.stderr, "bunny1: couldn't write access log %s: %s" % (self.path, e)
+            finally:
+                self._write_lock.release()
+
+    def _drain(self, lines):
+        """writes lines and everything that's waiting in the queue"""
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                lines.append(self._format(*record))
+            except Exception, e:
+                print >> sys.stderr, "bunny1: couldn't log %r to access log %s: %s" % (record, self.path, e)
+        if lines:
+            self._write("".join(lines))
+
+    def _sync(self):
+        if self._dirty:
+            os.fsync(self._file.fileno())
+            self._dirty = False
+        self._synced = time.time()
+
+    def _format(self, start, command, outcome, url, elapsed, raw):
+        # the same as json.dumps with sorted keys and no spaces, but a
+        # lot quicker since this is done for every command.  commands and
+        # URLs are bytes that can be anything, so they're decoded first.
+        if raw:
+            # the word that fell back, skipping any decorators
+            for word in raw.split():
+                if not word.startswith("@"):
+                    command = word
+                    break
+        if not isinstance(command, unicode):
+            command = command.decode("utf-8", "replace")
+        if url is None:
+            return '{"command":%s,"ms":%.3f,"outcome":"%s","time":%.3f}\n' % (
+                json_string(command), elapsed * 1000, outcome, start)
+        if not isinstance(url, unicode):
+            url = url.decode("utf-8", "replace")
+        return '{"command":%s,"host":%s,"ms":%.3f,"outcome":"%s","time":%.3f}\n' % (
+            json_string(command), json_string(urlparse.urlsplit(url)[1]),
+            elapsed * 1000, outcome, start)
+
+    def _write(self, data):
+        while True:
+            f = self._open()
+            _flock(f, LOCK_EX)
+            if not self._rotated(f):
+                break
+            # another process rotated it while we waited for the lock
+            _flock(f, LOCK_UN)
+        try:
+            f.write(data)
+            f.flush()
+            self._dirty = True
+            if os.fstat(f.fileno()).st_size > self.max_bytes:
+                os.fsync(f.fileno())
+                self._rotate()
+        finally:
+            _flock(f, LOCK_UN)
+
+    def _open(self):
+        """returns the log file, reopening it if another process (ex.
+        another worker) has rotated it out from under us"""
+        f = self._file
+        if f is not None and self._rotated(f):
+            if self._dirty:
+                os.fsync(f.fileno())
+                self._dirty = False
+            f.close()
+            f = None
+        if f is None:
+            f = self._file = open(self.path, "ab")
+        return f
+
+    def _rotated(self, f):
+        """tells whether f is no longer the file at path"""
+        try:
+            return os.stat(self.path).st_ino != os.fstat(f.fileno()).st_ino
+        except OSError:
+            return True
+
+    def _rotate(self):
+        """moves path to path.1, path.1 to path.2, and so on.  the caller
+        must hold an exclusive lock on the log."""
+        for i in xrange(self.backups - 1, 0, -1):
+            older = "%s.%d" % (self.path, i)
+            if os.path.exists(older):
+                os.rename(older, "%s.%d" % (self.path, i + 1))
+        if self.backups > 0:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.unlink(self.path)
+
+try:
+    from json.encoder import encode_basestring_ascii as json_string
+except ImportError:
+    # simplejson
+    from simplejson.encoder import encode_basestring_ascii as json_string
+
+class WorkerStats(object):
+    """shares history and popularity between the worker processes of a
+    prefork server (see Bunny1.start).  each worker periodically writes
+    what it has seen since it was forked to its own file in a shared
+    directory, and reads the other workers' files whenever history or
+    popularity is looked at.  files from workers that have died are left
+    in place so that what they counted isn't lost."""
+
+    def __init__(self, directory, interval=1.0):
+        self.directory = directory
+        self.interval = interval
+        self.path = None
+        # path -> ((mtime, size), counts, queries)
+        self._peers = {}
+
+    def attach(self, commands):
+        """starts sharing commands' history and popularity.  call this in
+        each worker right after it's forked."""
+        self.path = os.path.join(self.directory, "%d.stats" % os.getpid())
+        self._history = commands.history
+        self._popularity = commands.popularity
+        # everything the worker inherited from the supervisor (ex. from
+        # the usage log) is already counted by every worker
+        self._baseline = commands.popularity.local_counts()
+        self._started = time.time()
+        self._popularity.sources.append(self.peer_counts)
+        self._history.sources.append(self.peer_history)
+        thread = threading.Thread(target=self._run, name="bunny1-worker-stats")
+        thread.setDaemon(True)
+        thread.start()
+
+    def publish(self):
+        """writes out this worker's counts and history"""
+        baseline = self._baseline
+        chunks = []
+        for (method, count) in self._popularity.local_counts().iteritems():
+            count -= baseline.get(method, 0)
+            if count:
+                chunks.append(pack_usage_record(count, UsageLog.COUNT, method))
+        for (when, raw) in self._history.local_last_timed():
+            if when < self._started:
+                break
+            chunks.append(pack_usage_record(when, UsageLog.QUERY, raw or ""))
+        tmp_path = self.path + ".tmp"
+        f = open(tmp_path, "wb")
+        try:
+            f.write("".join(chunks))
+        finally:
+            f.close()
+        os.rename(tmp_path, self.path)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.publish()
+            except (IOError, OSError), e:
+                print >> sys.stderr, "bunny1: couldn't publish worker stats to %s: %s" % (self.path, e)
+
+    def _read_peers(self):
+        peers = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return peers
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".stats") or path == self.path:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            version = (st.st_mtime, st.st_size)
+            cached = self._peers.get(path)
+            if cached is None or cached[0] != version:
+                counts = {}
+                queries = []
+                for (num, kind, text) in read_usage_records(path):
+                    if kind == UsageLog.COUNT:
+                        counts[text] = int(num)
+                    elif kind == UsageLog.QUERY:
+                        queries.append((num, text))
+                cached = (version, counts, queries)
+                self._peers[path] = cached
+            peers.append(cached)
+        return peers
+
+    def peer_counts(self):
+        """the popularity counts from the other workers, merged"""
+        merged = {}
+        for (version, counts, queries) in self._read_peers():
+            _merge_counts(merged, counts)
+        return merged
+
+    def peer_history(self):
+        """the history from the other workers"""
+        merged = []
+        for (version, counts, queries) in self._read_peers():
+            merged.extend(queries)
+        return merged
+
+class AliasStore(object):
+    """keeps users' aliases in a sqlite database on the server, keyed by
+    a random token that's kept in a single cookie, instead of keeping
+    every alias in its own cookie that gets sent with every request.
+    each user's aliases are cached in an LRU of cache_size users, which
+    is emptied when another process (ex. another worker) has written to
+    the database.  that's checked at most every check_interval seconds,
+    since checking costs about as much as looking the aliases up."""
+
+    def __init__(self, path, cache_size=4096, check_interval=0.1):
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self.path = path
+        self.cache = LRUCache(cache_size)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # held while a new token is made for a user (see
+        # Bunny1Commands._alias_token)
+        self.token_lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        # sqlite's data_version as of the last check, and when that was
+        self._version = None
+        self._checked = 0
+        db = self._connection()
+        db.execute("CREATE TABLE IF NOT EXISTS aliases (token TEXT, alias TEXT, real TEXT, PRIMARY KEY (token, alias))")
+        db.commit()
+
+    def _connection(self):
+        # connections can't be shared with worker processes, so each
+        # process opens its own the first time it needs one
+        if self._pid != os.getpid():
+            self._db = self._sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            self._db.text_factory = str
+            self._pid = os.getpid()
+            # data_versions from different connections can't be compared
+            self._version = None
+        return self._db
+
+    def _check(self):
+        """empties the cache if anyone else has written to the database
+        since the last check.  sqlite's data_version changes whenever
+        another connection commits."""
+        now = time.time()
+        if now - self._checked < self.check_interval and self._pid == os.getpid():
+            return
+        self._lock.acquire()
+        try:
+            version = self._connection().execute("PRAGMA data_version").fetchone()[0]
+        finally:
+            self._lock.release()
+        if version != self._version:
+            self.cache.clear()
+            self._version = version
+        self._checked = now
+
+    def new_token(self):
+        return os.urandom(16).encode("hex")
+
+    def aliases(self, token):
+        """returns a dict of all of token's aliases.  don't change it."""
+        self._check()
+        aliases = self.cache.get(token)
+        if aliases is None:
+            self._lock.acquire()
+            try:
+                rows = self._connection().execute("SELECT alias, real FROM aliases WHERE token = ?", (token,)).fetchall()
+            finally:
+                self._lock.release()
+            aliases = dict(rows)
+            self.cache.put(token, aliases)
+        return aliases
+
+    def get(self, token, alias):
+        return self.aliases(token).get(alias)
+
+    def update(self, token, aliases):
+        """sets the (alias, real) pairs in aliases for token"""
+        self._write("INSERT OR REPLACE INTO aliases (token, alias, real) VALUES (?, ?, ?)",
+                    [(token, alias, real) for (alias, real) in aliases], token)
+
+    def remove(self, token, alias):
+        self._write("DELETE FROM aliases WHERE token = ? AND alias = ?", [(token, alias)], token)
+
+    def _write(self, sql, rows, token):
+        self._lock.acquire()
+        try:
+            db = self._connection()
+            db.executemany(sql, rows)
+            db.commit()
+        finally:
+            self._lock.release()
+        self.cache.pop(token)
+
+class UpstreamBunny1(object):
+    """resolves commands against another bunny1 server over HTTP.  with a
+    chain of bunny1 servers (ex. personal -> team -> company) falling back
+    to each other, this sends the browser straight to where it's going
+    instead of redirecting it through every server in the chain.
+
+    connections are kept alive and reused, and the redirects that come
+    back are cached for ttl seconds.  if the upstream server can't be
+    reached within timeout seconds, resolve returns None and it isn't
+    tried again for retry_after seconds.
+
+    if blocking is False (ex. on AsyncServer's event loop, which can't
+    wait on anything), resolve only answers from the cache.  a miss
+    returns None and the upstream server is asked on one of pool_size
+    background threads, so the answer is cached for next time."""
+
+    def __init__(self, url, timeout=1.0, ttl=300, maxsize=1024, pool_size=8, retry_after=5.0):
+        (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+        if scheme == "http":
+            self._connection_class = httplib.HTTPConnection
+        elif scheme == "https":
+            self._connection_class = httplib.HTTPSConnection
+        else:
+            raise ValueError("the upstream bunny1 URL has to be http or https: %s" % url)
+        self.url = urlparse.urlunsplit((scheme, netloc, path or "/", "", ""))
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.cache = LRUCache(maxsize, ttl)
+        self._netloc = netloc
+        self._path = path or "/"
+        self._pool = Queue.LifoQueue(pool_size)
+        self._down_until = 0
+        self.blocking = True
+        self._workers = WorkerPool(pool_size, "bunny1-upstream")
+        # the commands being asked about in the background
+        self._fetching = set()
+        self._fetching_lock = threading.Lock()
+
+    def resolve(self, raw, hops=0):
+        """returns the Redirect or Content that the upstream server gives
+        for raw, or None if it couldn't be asked"""
+        result = self.cache.get(raw)
+        if result is not None:
+            return result
+        if time.time() < self._down_until:
+            return None
+        if not self.blocking:
+            self._fetch_later(raw, hops)
+            return None
+        return self._fetch(raw, hops)
+
+    def _fetch_later(self, raw, hops):
+        """asks the upstream server about raw on a background thread, unless
+        it is already being asked or the threads are all busy"""
+        self._fetching_lock.acquire()
+        try:
+            if raw in self._fetching or len(self._fetching) >= self._workers.num_threads:
+                return
+            self._fetching.add(raw)
+        finally:
+            self._fetching_lock.release()
+        self._workers.submit(self._fetch_in_background, raw, hops)
+
+    def _fetch_in_background(self, raw, hops):
+        try:
+            self._fetch(raw, hops)
+        finally:
+            self._fetching_lock.acquire()
+            try:
+                self._fetching.discard(raw)
+            finally:
+                self._fetching_lock.release()
+
+    def _fetch(self, raw, hops):
+        """asks the upstream server about raw, and caches redirects"""
+        path = "%s?%s=%s" % (self._path, COMMAND_QUERY_STRING_VAR, qp(raw))
+        try:
+            (status, location, content_type, body) = self._get(path, hops + 1)
+        except (socket.error, httplib.HTTPException), e:
+            self._down_until = time.time() + self.retry_after
+            print >> sys.stderr, "bunny1: couldn't reach upstream bunny1 at %s: %s" % (self.url, e)
+            return None
+        if 300 <= status < 400 and location:
+            result = Redirect(urlparse.urljoin(self.url, location))
+            self.cache.put(raw, result)
+            return result
+        if status == 200:
+            # content can depend on who's asking (ex. history) so it isn't cached
+            return Content(body, content_type or "text/html")
+        return None
+
+    def _get(self, path, hops):
+        """makes a GET request on a pooled connection and returns
+        (status, location, content type, body)"""
+        for attempt in (1, 2):
+            try:
+                conn = self._pool.get_nowait()
+                reused = True
+            except Queue.Empty:
+                conn = self._connection_class(self._netloc, timeout=self.timeout)
+                reused = False
+            try:
+                conn.request("GET", path, headers={HOPS_HEADER: str(hops)})
+                response = conn.getresponse()
+                body = response.read()
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                # the server may have closed a kept alive connection while
+                # it sat in the pool, so try once more on a new one
+                if reused and attempt == 1 and not isinstance(e, socket.timeout):
+                    continue
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                try:
+                    self._pool.put_nowait(conn)
+                except Queue.Full:
+                    conn.close()
+            return (response.status, response.getheader("location"),
+                    response.getheader("content-type"), body)
+
+def federation_hops():
+    """how many bunny1 servers the current request has been through"""
+    try:
+        return int(cherrypy.request.headers.get(HOPS_HEADER, 0))
+    except ValueError:
+        return MAX_FEDERATION_HOPS
+
 class Bunny1Commands(object):
     """the default commands used by bunny1"""
 
+    # override this in a subclass to remember more or fewer queries
+    history_size = DEFAULT_HISTORY_SIZE
+
+    # an UpstreamBunny1 that fallback asks before redirecting (see federate)
+    upstream = None
+
+    # an AliasStore to keep aliases in instead of cookies (see use_alias_store)
+    alias_store = None
+
     def __init__(self):
-        self.history = []
+        self.history = History(self.history_size)
         self.fallback_url = YUBNUB_URL
-        self.popularity = {}
+        self.popularity = ShardedCounter()
+        self._page_cache = PageCache()
+        self.profiler = SamplingProfiler()
+        self.memory = MemorySnapshots()
 
     @dont_expose
     def _base_url(self):
@@ -335,6 +3371,7 @@ class Bunny1Commands(object):
         # at some point, it might be good to deal with that
         return "<html><head><title>bunny1</title>" + self._opensearch_link() + "</head><body><form><input type='text' name='" + COMMAND_QUERY_STRING_VAR + "' value='list'><input type='submit' value='try me'></form><pre>" + escape(bunny1_file("README")) + "</pre></body></html>"
 
+    @cached_page("help")
     def help(self, arg):
         """gets help with a specific command or shows the README for general help"""
         if arg:
@@ -343,6 +3380,7 @@ class Bunny1Commands(object):
             raise Content(self._help_html())
     man = help
 
+    @cached_page("readme")
     def readme(self, arg):
         """shows the README for this tool"""
         raise Content(self._help_html())
@@ -361,13 +3399,101 @@ class Bunny1Commands(object):
             }) + "</code>")
 
 
+    # _profile, _memory and _cache show what the code in this server is
+    # doing or change it, so like _info they aren't exposed by default.
+    # to turn them on, make sure auth only lets admins in and override
+    # them in your commands class, ex.
+    #     @bunny1.unlisted
+    #     def _profile(self, arg):
+    #         return bunny1.Bunny1Commands._profile(self, arg)
+    # with --workers, they only see the worker that handles the request.
+
+    @dont_expose
+    def _profile(self, arg):
+        """samples what the server is doing: _profile start [seconds], stop, or dump"""
+        args = arg.split()
+        if args and args[0] == "start":
+            seconds = DEFAULT_PROFILE_SECONDS
+            if len(args) > 1:
+                try:
+                    seconds = float(args[1])
+                except ValueError:
+                    return ErrorMesage("%s isn't a number of seconds" % args[1])
+            seconds = min(seconds, MAX_PROFILE_SECONDS)
+            self.profiler.start(seconds)
+            return Content("profiling for %g seconds.  <a href='/?_profile+dump'>dump</a> or <a href='/?_profile+stop'>stop</a>" % seconds)
+        elif args and args[0] == "stop":
+            self.profiler.stop()
+            return Content(self.profiler.collapsed(), "text/plain")
+        elif args and args[0] == "dump":
+            return Content(self.profiler.collapsed(), "text/plain")
+
+        if self.profiler.running():
+            status = "running, %d samples so far" % self.profiler.samples
+        else:
+            status = "not running"
+        return Content("profiler %s<br />usage: _profile start [seconds] | stop | dump" % status)
+
+    @dont_expose
+    def _memory(self, arg):
+        """diffs snapshots of memory use: _memory snapshot, diff, or stop"""
+        if arg == "snapshot":
+            self.memory.snapshot()
+            return Content("took a snapshot.  <a href='/?_memory+diff'>diff</a> against it later")
+        elif arg == "diff":
+            report = self.memory.diff()
+            if report is None:
+                return Content("there was no snapshot to diff against, so this took one.  <a href='/?_memory+diff'>diff</a> against it later")
+            return Content(report, "text/plain")
+        elif arg == "stop":
+            self.memory.stop()
+            return Content("stopped.")
+        return Content("usage: _memory snapshot | diff | stop")
+
+    @dont_expose
+    def _cache(self, arg):
+        """shows how the caches of @cacheable commands are doing, or empties them with _cache flush [name ...]"""
+        caches = self._caches()
+        args = arg.split()
+        if args and args[0] == "flush":
+            for (name, cache) in caches:
+                if len(args) == 1 or name in args[1:]:
+                    cache.clear()
+            return Content("flushed.")
+
+        html = "<table><tr><th>cache</th><th>entries</th><th>max</th><th>ttl</th><th>hits</th><th>misses</th></tr>"
+        for (name, cache) in caches:
+            html += "<tr><td><b>%s</b></td><td>%d</td><td>%d</td><td>%s</td><td>%d</td><td>%d</td></tr>" % (
+                escape(name), len(cache), cache.maxsize, cache.ttl, cache.hits, cache.misses)
+        html += "</table>"
+        return Content(html)
+
+    @dont_expose
+    def _caches(self):
+        """(name, LRUCache) pairs for the page cache and every @cacheable
+        command and decorator"""
+        caches = [("pages", self._page_cache._pages)]
+        seen = set([id(self._page_cache._pages)])
+        owners = [self]
+        if hasattr(self, "_b1"):
+            owners.append(self._b1.decorators)
+        for owner in owners:
+            for name in dir(owner):
+                cache = getattr(getattr(owner, name, None), "cache", None)
+                if isinstance(cache, LRUCache) and id(cache) not in seen:
+                    seen.add(id(cache))
+                    if owner is not self:
+                        name = "@" + name
+                    caches.append((name, cache))
+        return caches
+
     # the history could be dangerous / embarassing to expose !
     @dont_expose
     def history(self, arg):
         """show the history of queries made to this server"""
 
         html = "<pre><b>history</b>\n"
-        for entry in self.history[:-50:-1]:
+        for entry in self.history.last(50):
             html += '<a href="/?%(url)s">%(label)s</a>\n' % {
                 "url": entry,
                 "label": entry,
@@ -376,28 +3502,37 @@ class Bunny1Commands(object):
         raise Content(html)
     h = history
 
-    # since command history is only stored in memory and not persisted,
-    # history and popularity data won't be available when running 
-    # in cgi mode.
+    # command history and popularity are only stored in memory unless
+    # you open a usage log (see Bunny1.open_usage_log and --usagelogfile),
+    # so without one they won't survive restarts or be available when
+    # running in cgi mode.
 
+    # the popular and list pages show counts, so they are cached per
+    # version of popularity's snapshot, which is refreshed at most every
+    # POPULARITY_MAX_AGE seconds.  checking the version is cheap, and the
+    # pages are rendered from that same snapshot.
+    @cached_page("popular", vary=lambda self, arg: self._popularity_version())
     def popular(self, arg):
         """shows the most popular commands"""
         raise Content(self._popularity_html())
 
+    @dont_expose
+    def _popularity_version(self):
+        return self.popularity.snapshot(POPULARITY_MAX_AGE)[0]
+
     @dont_expose
     def _popularity_html(self, num=None):
-        p = self.popularity
-        pairs = [(val, key) for (key, val) in p.items() if key not in DONT_LIST_AS_POPULAR]
-        pairs.sort()
-        pairs.reverse()
+        pairs = self.popularity.most_common(num, DONT_LIST_AS_POPULAR, POPULARITY_MAX_AGE)
         html = "<b><i>"
         if num:
             html += "%d " % num
         html += "Most Popular Commands</i></b><br />"
-        if num:
-            pairs = pairs[:num]
         for (times, method) in pairs:
-            m = getattr(self, method)
+            # counts can outlive their commands (ex. ones loaded from a
+            # usage log, or from before a reload took a command away)
+            m = getattr(self, method, None)
+            if m is None:
+                continue
             doc = m.__doc__
             if not getattr(m, "unlisted", False):
                 if doc:
@@ -407,39 +3542,35 @@ class Bunny1Commands(object):
                 html += "<b>%s</b> used %d times%s<br />\n" % (escape(method), times, doc_str)
         return html
 
+    # the list of all commands starts with the top 10 and their counts
+    @cached_page("list", vary=lambda self, arg: not arg and self._popularity_version())
     def list(self, arg):
         """show the list of methods you can use or search that list"""
 
-        def is_exposed_method( (name, method) ):
-            return not name.startswith("__") and callable(method) \
-                       and method.__doc__ and not getattr(method, "dont_expose", False) \
-                       and not getattr(method, "unlisted", False)
-
-        arg_lower = None
         if arg:
-            arg_lower = arg.lower()
             html = ""
-            search_predicate = lambda (name, method): is_exposed_method((name,method)) and \
-                               (arg_lower in name.lower() or arg_lower in method.__doc__)
+            commands = self._command_index().search(arg)
         else:
             html = self._popularity_html(10) + "<hr ><b><i>All Commands</i></b><br />"
-            search_predicate = is_exposed_method
-
-        attr_names = dir(self)
-
-        def attr_getter(name): return getattr(self, name)
+            commands = self._command_index().listed
 
         html += '<table>'
         html += ''.join(
-            ['<tr><td><b>%s</b></td><td>%s</td></tr>' % (name, escape(method.__doc__)) for
-             name, method in ifilter(search_predicate,
-                                     izip(attr_names, imap(attr_getter, attr_names)))])
+            ['<tr><td><b>%s</b></td><td>%s</td></tr>' % (name, escape(doc)) for
+             (name, doc) in commands])
         html += '<table>'
 
         raise Content(html)
     ls = list
     commands = list
 
+    @dont_expose
+    def _command_index(self):
+        """the search index over the commands that list shows"""
+        if hasattr(self, "_b1"):
+            return self._b1.command_table.index
+        return CommandTable(self).index
+
     def echo(self, arg):
         """returns back what you give to it"""
         raise Content(escape(arg))
@@ -454,6 +3585,136 @@ class Bunny1Commands(object):
         import socket
         raise Content(socket.gethostname())
 
+    @dont_expose
+    def load_plugins(self, manifest):
+        """adds the commands from the plugin modules in manifest, without
+        importing any of them until their commands are used.  manifest is
+        a dict (or the path of a JSON file with one) like
+            {"module": {"command": {"doc": "...", "unlisted": true}, ...}, ...}
+        where a command can also just be given its doc.  see
+        write_plugin_manifest for making one.  commands whose names start
+        with _ or that something other than a plugin already has are
+        skipped, so that a manifest can't replace the built in commands."""
+        # so that a Reloader can load them into new commands
+        self._plugins = getattr(self, "_plugins", []) + [manifest]
+        if isinstance(manifest, basestring):
+            f = open(manifest)
+            try:
+                manifest = json.load(f)
+            finally:
+                f.close()
+        for (module, commands) in manifest.iteritems():
+            for (name, info) in commands.iteritems():
+                if isinstance(info, basestring) or info is None:
+                    info = {"doc": info}
+                name = str(name)
+                if name.startswith("_"):
+                    print >> sys.stderr, "bunny1: not loading %s from plugin %s because plugin commands can't start with _" % (name, module)
+                    continue
+                if hasattr(self, name) and not isinstance(self.__dict__.get(name), LazyCommand):
+                    print >> sys.stderr, "bunny1: not loading %s from plugin %s because %s already exists" % (name, module, name)
+                    continue
+                doc = info.get("doc")
+                if isinstance(doc, unicode):
+                    doc = doc.encode("utf-8")
+                setattr(self, name, LazyCommand(self, str(module), name, doc,
+                        info.get("unlisted", False), info.get("no_auth_required", False)))
+        if hasattr(self, "_b1"):
+            self._b1.rebuild_command_table()
+
+    # aliases are kept in alias.<name> cookies unless there is an alias
+    # store, in which case they're kept on the server and the browser only
+    # has a token for them.  alias cookies left over from before there was
+    # a store get moved into it the first time they're seen.
+
+    @dont_expose
+    def use_alias_store(self, path, **kwargs):
+        """keeps aliases in an AliasStore at path instead of in cookies"""
+        self.alias_store = AliasStore(path, **kwargs)
+
+    @dont_expose
+    def lookup_alias(self, name):
+        """returns what name is aliased to for the current user, or None"""
+        if self.alias_store:
+            token = self._alias_token()
+            if token:
+                return self.alias_store.get(token, name)
+        try:
+            return cherrypy.request.cookie[ALIAS_COOKIE_PREFIX + name].value
+        except KeyError:
+            return None
+
+    @dont_expose
+    def aliases(self):
+        """returns a dict of all of the current user's aliases"""
+        if self.alias_store:
+            token = self._alias_token()
+            if token:
+                return self.alias_store.aliases(token)
+        return self._alias_cookies()
+
+    @dont_expose
+    def set_alias(self, name, real):
+        if self.alias_store:
+            self.alias_store.update(self._alias_token(True), [(name, real)])
+        else:
+            cherrypy.response.cookie[ALIAS_COOKIE_PREFIX + name] = real
+
+    @dont_expose
+    def remove_alias(self, name):
+        if self.alias_store:
+            token = self._alias_token()
+            if token:
+                self.alias_store.remove(token, name)
+        else:
+            cherrypy.response.cookie[ALIAS_COOKIE_PREFIX + name] = ""
+            cherrypy.response.cookie[ALIAS_COOKIE_PREFIX + name]["expires"] = 0
+
+    @dont_expose
+    def _alias_cookies(self):
+        cookie = cherrypy.request.cookie
+        return dict([(name[len(ALIAS_COOKIE_PREFIX):], cookie[name].value) for
+                     name in cookie.keys() if name.startswith(ALIAS_COOKIE_PREFIX)])
+
+    @dont_expose
+    def _alias_token(self, create=False):
+        """the current user's alias store token.  if they don't have one
+        yet, one is made if they have alias cookies to move into the store
+        or if create is True."""
+        request = cherrypy.request
+        token = getattr(request, "alias_token", None)
+        if token:
+            return token
+        try:
+            return request.cookie[ALIAS_TOKEN_COOKIE].value
+        except KeyError:
+            pass
+        old = self._alias_cookies()
+        if not old and not create:
+            return None
+        # the threads of a batch each have a copy of the batch's request
+        # (see Bunny1.batch), and should all use the same token
+        shared = getattr(request, "batch_request", request)
+        self.alias_store.token_lock.acquire()
+        try:
+            token = getattr(shared, "alias_token", None)
+            if token is None:
+                token = self.alias_store.new_token()
+                save(ALIAS_TOKEN_COOKIE, token)
+                if old:
+                    self.alias_store.update(token, old.items())
+                    for name in old:
+                        cherrypy.response.cookie[ALIAS_COOKIE_PREFIX + name] = ""
+                        cherrypy.response.cookie[ALIAS_COOKIE_PREFIX + name]["expires"] = 0
+                shared.alias_token = token
+        finally:
+            self.alias_store.token_lock.release()
+        # later lookups in this request (ex. the rest of a batch) see the
+        # new token.  it's kept out of request.cookie, which other requests
+        # can share (ex. copies of the request in a batch).
+        request.alias_token = token
+        return token
+
     def _cookies(self, arg):
         """show the cookies set on this server or search through them"""
         cookie = cherrypy.request.cookie
@@ -467,33 +3728,27 @@ class Bunny1Commands(object):
     def alias(self, arg):
         """aliases one shortcut to another.  ex: alias p profile.  alias p will show what p is aliased to.  alias with no args will show all aliases."""
         words = arg.split()
-        cookie = cherrypy.response.cookie
-        try:
-            alias = words[0]
-            real = words[1]
-            cookie["alias." + alias] = real
+        if len(words) >= 2:
+            (alias, real) = words[:2]
+            self.set_alias(alias, real)
             raise Content("aliased <b>%s</b> to <b>%s</b>" % (escape(alias), escape(real)))
-        except IndexError:
-            try:
-                alias = words[0]
-                try:
-                    raise Content("<b>%s</b> is aliased to <b>%s</b>" % (escape(alias), escape(cherrypy.request.cookie["alias." + alias].value)))
-                except KeyError:
-                    raise Content("<b>%s</b> is not aliased to anything." % escape(arg))
-            except IndexError:
-                html = "usage:<br />alias <i>alias</i> <i>real-command</i><br />or<br />alias <i>alias</i><br /><hr />"
-                cookie = cherrypy.request.cookie
-                for name in cookie.keys():
-                    if str(name).startswith("alias."):
-                        html += "<b>%s</b> is aliased to <b>%s</b><br />" % (escape(name[6:]), escape(cookie[name].value))
-                raise Content(html)
+        elif words:
+            alias = words[0]
+            real = self.lookup_alias(alias)
+            if real is None:
+                raise Content("<b>%s</b> is not aliased to anything." % escape(arg))
+            raise Content("<b>%s</b> is aliased to <b>%s</b>" % (escape(alias), escape(real)))
+        else:
+            html = "usage:<br />alias <i>alias</i> <i>real-command</i><br />or<br />alias <i>alias</i><br /><hr />"
+            for (alias, real) in sorted(self.aliases().items()):
+                html += "<b>%s</b> is aliased to <b>%s</b><br />" % (escape(alias), escape(real))
+            raise Content(html)
 
     def unalias(self, arg):
         """unaliases an alias.  ex: unalias p"""
         if not arg:
             raise Content("usage:<br />unalias <i>alias</i>")
-        cherrypy.response.cookie["alias." + arg] = ""
-        cherrypy.response.cookie["alias." + arg]["expires"] = 0
+        self.remove_alias(arg)
         raise Content("unaliased <b>%s</b>" % escape(arg))
 
     def _source(self, arg):
@@ -546,27 +3801,46 @@ class Bunny1Commands(object):
                 "short_name": "bunny1",
                 "description": "bunny1",
                 "template": self._my_url() + "?{searchTerms}",
+                "suggest_template": self._my_url() + "?" + SUGGEST_QUERY_STRING_VAR + "={searchTerms}",
             }
 
+    @cached_page("_opensearch")
     def _opensearch(self, arg):
         """returns the OpenSearch description for this server"""
         m = self._opensearch_metadata()
+        suggest_url = ""
+        if m.get("suggest_template"):
+            suggest_url = """<Url type="application/x-suggestions+json" template=\"""" + escape(m["suggest_template"]) + """\" />
+    """
         raise Content("""<?xml version="1.0" encoding="UTF-8" ?>
     <OpenSearchDescription xmlns="http://a9.com/-/spec/opensearch/1.1/">
     <ShortName>""" + m["short_name"] + """</ShortName>
     <Description>""" + m["description"] + """</Description>
     <InputEncoding>UTF-8</InputEncoding>
     <Url type="text/html" template=\"""" + escape(m["template"]) + """\" />
-  </OpenSearchDescription>
+    """ + suggest_url + """</OpenSearchDescription>
   """, "application/xml")
 
     def keywurl(self, arg):
         """goes to the Keywurl Safari extension homepage"""
         return "http://purefiction.net/keywurl/"
 
+    @dont_expose
+    def federate(self, url, **kwargs):
+        """makes fallback resolve queries against the bunny1 server at url
+        and send the browser straight to wherever that goes, instead of
+        redirecting the browser to that server.  if it can't be reached,
+        fallback redirects to it like usual.  kwargs go to UpstreamBunny1."""
+        self.upstream = UpstreamBunny1(url, **kwargs)
+        self.fallback_url = self.upstream.url + "?"
+
     @dont_expose
     def fallback(self, raw):
-        raise HTTPRedirect(self.fallback_url + q(raw))
+        if self.upstream and federation_hops() < MAX_FEDERATION_HOPS:
+            result = self.upstream.resolve(raw, federation_hops())
+            if result is not None:
+                return result
+        return Redirect(self.fallback_url + q(raw))
 
 class DoesNotExist(Exception):
     pass
@@ -580,9 +3854,13 @@ def save(key, val):
 def load(key):
     return cherrypy.request.cookie[key].value
 
+def bunny1_path(name):
+    """the path of a file in the same directory as bunny1"""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
 def bunny1_file(name):
     """the binary contents of a file in the same directory as bunny1"""
-    return file(os.path.dirname(__file__) + os.path.sep + name).read()
+    return file(bunny1_path(name)).read()
 
 class Bunny1OptionParser(optparse.OptionParser):
     """a class for getting bunny1 options"""
@@ -598,8 +3876,18 @@ class Bunny1OptionParser(optparse.OptionParser):
         self.add_option("--pidfile", dest="pidfile", help="pidfile to write to")
         self.add_option("--errorlogfile", dest="errorlogfile", help="file to write error logs to (defaults to stdout)")
         self.add_option("--accesslogfile", dest="accesslogfile", help="file to write access logs to (defaults to stdout)")
+        self.add_option("--commandlogfile", dest="commandlogfile", help="file to log each command's name, outcome, redirect host, and latency to as JSON lines")
         self.add_option("--test-command", "-t", dest="test_command", help="test some command at the command line")
+        self.add_option("--batch", dest="batch", help="resolve each line of BATCH (- for stdin) as a command and write a line of JSON about each one")
+        self.add_option("--processes", dest="processes", type="int", default=1, help="number of processes to spread --batch across (default 1)")
         self.add_option("--base-url", "-u", dest="base_url", help="the base URL of the bunny1 server")
+        self.add_option("--engine", dest="engine", type="choice", choices=[Engines.CHERRYPY, Engines.ASYNC], default=Engines.CHERRYPY, help="the HTTP server to use: cherrypy (the default) or async, a lighter weight single-threaded server")
+        self.add_option("--reload", dest="reload", action="store_true", help="reload commands when their code changes without restarting")
+        self.add_option("--workers", "-w", dest="workers", type="int", default=1, help="number of worker processes to prefork (default 1)")
+        self.add_option("--usagelogfile", dest="usagelogfile", help="file to persist history and popularity to so they survive restarts")
+        self.add_option("--plugins", dest="plugins", help="JSON manifest of plugin modules whose commands get imported the first time they're used")
+        self.add_option("--aliasdb", dest="aliasdb", help="sqlite file to keep aliases in on the server instead of in a cookie per alias")
+        self.add_option("--upstream", dest="upstream", help="URL of a bunny1 server to resolve unknown commands against instead of redirecting to it")
 
 class PasswordProtectionCommands(object):
     """commands for password protection"""
@@ -645,23 +3933,51 @@ class PasswordProtectedBunny1(Bunny1):
         # http://www.rickadams.org/adventure/c_xyzzy.html
         return "xyzzy"
 
-def main(b1, b1op=Bunny1OptionParser()):
+def main(b1, b1op=None):
     """uses command line options and runs the server given an instance of the Bunny1 class"""
 
     # guess if this is running in CGI mode
     if os.environ.get("GATEWAY_INTERFACE", "").startswith("CGI"):
         main_cgi(b1)
     else:
+        if b1op is None:
+            b1op = Bunny1OptionParser()
         (options, args) = b1op.parse_args()
 
+        if options.usagelogfile:
+            b1.open_usage_log(options.usagelogfile)
+
+        if options.plugins:
+            b1.commands.load_plugins(options.plugins)
+
+        if options.commandlogfile:
+            b1.open_access_log(options.commandlogfile)
+
+        if options.reload:
+            b1.watch()
+
+        if options.upstream:
+            b1.commands.federate(options.upstream)
+
+        if options.aliasdb:
+            b1.commands.use_alias_store(options.aliasdb)
+
         if options.test_command is not None:
-            try:
-                b1._server_mode = "COMMAND_LINE"
-                print b1.do_command(options.test_command)
-            except HTTPRedirect, redir:
+            b1._server_mode = "COMMAND_LINE"
+            result = b1.resolve(options.test_command)
+            if isinstance(result, Redirect):
                 # the escape sequences make the output show up yellow on terminals
                 # in the case of a redirect to distinguish from content output
-                print "\033[33m%s:\033[0m %s" % (redir.__class__.__name__, redir)
+                print "\033[33m%s:\033[0m %s" % (result.__class__.__name__, result.url)
+            else:
+                print result.html
+        elif options.batch is not None:
+            b1._server_mode = "COMMAND_LINE"
+            if options.batch == "-":
+                f = sys.stdin
+            else:
+                f = open(options.batch)
+            run_batch(b1, f, sys.stdout, options.processes)
         else:
 
             if options.port:
@@ -685,33 +4001,77 @@ def main(b1, b1op=Bunny1OptionParser()):
                 daemonize.daemonize(options.pidfile)
 
             # start the server
-            b1.start(port=port, host=options.host, errorlogfile=options.errorlogfile, accesslogfile=options.accesslogfile)
+            b1.start(port=port, host=options.host, errorlogfile=options.errorlogfile, accesslogfile=options.accesslogfile, workers=options.workers, engine=options.engine)
+
+
+def wsgi_app(b1):
+    """returns a WSGI application for an instance of Bunny1.
+
+    this is the way to run bunny1 in a persistent container (ex. mod_wsgi,
+    a FastCGI server, or anything else that speaks WSGI) so that the
+    interpreter and commands are set up once instead of on every request.
+    ex. in a .wsgi file:
+        application = bunny1.wsgi_app(MyBunny())
+    """
+    return b1.wsgi
 
+# the instance run_batch's worker processes use, which they get by forking
+_batch_b1 = None
+
+def _check_line(raw):
+    try:
+        return json.dumps(_batch_b1.check(raw), separators=(",", ":"), sort_keys=True)
+    except Exception, e:
+        # ex. a command that redirects to a URL that isn't UTF-8
+        return json.dumps({"command": raw, "outcome": Outcomes.ERROR,
+                           "error": "%s: %s" % (e.__class__.__name__, e)},
+                          separators=(",", ":"), sort_keys=True)
+
+def run_batch(b1, f, out, processes=1):
+    """resolves each line of f as a command and writes a line of JSON
+    about what it did (see Bunny1.check) to out, in the same order.  f is
+    read as it goes, so this runs in constant memory however many
+    commands there are.  if processes is more than 1, the commands are
+    spread across that many forked worker processes.  lines that aren't
+    UTF-8 have the bad bytes replaced so that they can still be checked
+    and written out as JSON."""
+    global _batch_b1
+    _batch_b1 = b1
+    raws = ifilter(None, (line.rstrip("\r\n").decode("utf-8", "replace").encode("utf-8") for line in f))
+    if processes <= 1:
+        for raw in raws:
+            out.write(_check_line(raw) + "\n")
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    try:
+        while True:
+            window = list(itertools.islice(raws, CLI_BATCH_WINDOW))
+            if not window:
+                break
+            for line in pool.imap(_check_line, window, CLI_BATCH_CHUNK):
+                out.write(line + "\n")
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 def main_cgi(b1):
     """for running bunny1 as a cgi"""
 
-    # this mostly works, but it has problems serving images andother
-    # static content
+    # each cgi request is a fresh process, so call b1.open_usage_log
+    # in your script before calling main if you want history and
+    # popularity to stick around between requests
 
-    try:
-        form = cgi.FieldStorage()
-        cmd = form.getvalue(COMMAND_QUERY_STRING_VAR)
-        if not cmd:
-            try:
-                cmd = urllib.unquote_plus(os.environ["QUERY_STRING"])
-            except KeyError:
-                cmd = DEFAULT_COMMAND
-        response = b1.do_command(cmd)
-        if cherrypy.response.headers['Content-type']:
-            content_type = cherrypy.response.headers['Content-type']
-        else:
-            content_type = "text/html"
-        print "Content-type: %s\n" % content_type
-        print response
-    except cherrypy.HTTPRedirect, redir:
-        url = redir.urls[0]
-        print "Location: " + url + "\n\n"
+    # every cgi request pays for starting python and setting up bunny1,
+    # so if your host has any kind of persistent WSGI or FastCGI
+    # container, you are much better off running wsgi_app(b1) in that
+
+    import wsgiref.handlers
+    wsgiref.handlers.CGIHandler().run(wsgi_app(b1))
 
 # it doesn't really make sense to run this module as a standalone program
 # but it may be useful for testing in some rare cases